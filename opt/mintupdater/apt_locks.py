@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+"""
+Lock-aware step runner for apt/dpkg work.
+
+Runs the install steps one after another as root (started once via pkexec).
+Before each step the dpkg and apt locks it needs are checked with fcntl(F_GETLK).
+If another program (mintupdate, Synaptic, unattended-upgrades, ...) holds them,
+the step waits behind the holder until the lock file is closed (inotify on the
+lock directory) or the shared lock wait budget is used up.
+
+A {"plan": "live"} step makes the live-safe install plan (install_plan.py)
+right here as root, where the processes of all users are visible, and is
+replaced by the steps installing the live-safe part.
+
+Only the standard library is used, because this file runs under pkexec
+without the user's GTK/D-Bus environment.
+"""
+import ctypes
+import ctypes.util
+import fcntl
+import json
+import os
+import select
+import struct
+import subprocess
+import sys
+import time
+
+import install_plan
+import mirrors
+import peer_cache
+
+# Lock files used by apt and dpkg
+DPKG_FRONTEND_LOCK = "/var/lib/dpkg/lock-frontend"
+DPKG_LOCK = "/var/lib/dpkg/lock"
+APT_LISTS_LOCK = "/var/lib/apt/lists/lock"
+APT_ARCHIVES_LOCK = "/var/cache/apt/archives/lock"
+
+# Locks needed by the different kinds of steps
+DPKG_LOCKS = [DPKG_FRONTEND_LOCK, DPKG_LOCK, APT_ARCHIVES_LOCK]
+APT_LISTS_LOCKS = [APT_LISTS_LOCK]
+
+# inotify constants (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+_EVENT_HEADER = struct.Struct("iIII")
+
+# Safety net: re-check the locks at least this often even without inotify events,
+# e.g. if a holder releases the lock with F_UNLCK but keeps the file open
+RECHECK_INTERVAL = 30
+
+# Marker for the result line printed on stdout for the calling process
+RESULT_PREFIX = "MINTUPDATER-RESULT "
+
+
+def get_lock_holder(path):
+    """
+    Returns the PID of the process holding a write-conflicting lock on path,
+    or None if the lock is free (or the file does not exist).
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    except FileNotFoundError:
+        return None
+    try:
+        # struct flock: l_type, l_whence, l_start, l_len, l_pid
+        request = struct.pack("hhlli", fcntl.F_WRLCK, os.SEEK_SET, 0, 0, 0)
+        answer = fcntl.fcntl(fd, fcntl.F_GETLK, request)
+        l_type, _, _, _, l_pid = struct.unpack("hhlli", answer)
+        if l_type == fcntl.F_UNLCK:
+            return None
+        # OFD locks report -1 as PID; the lock is still held
+        return l_pid
+    finally:
+        os.close(fd)
+
+
+def process_name(pid):
+    """
+    Returns the command name of a process, or 'unknown'.
+    """
+    if pid is None or pid <= 0:
+        return "unknown"
+    try:
+        with open(f"/proc/{pid}/comm", "r") as f:
+            return f.read().strip()
+    except OSError:
+        return "unknown"
+
+
+def find_lock_holders(paths):
+    """
+    Returns a list of (path, pid, name) for every lock in paths that is currently held.
+    """
+    holders = []
+    for path in paths:
+        pid = get_lock_holder(path)
+        if pid is not None:
+            holders.append((path, pid, process_name(pid)))
+    return holders
+
+
+class LockWatcher:
+    """
+    Wakes up when one of the watched lock files is closed by any process.
+    apt and dpkg open their locks read-write and release them by closing the
+    lock file, so an IN_CLOSE_WRITE event on the lock directory is the moment
+    to re-check. Read-only opens (including our own F_GETLK probes) are not
+    watched, otherwise every re-check would wake the watcher up again.
+    Falls back to plain timeouts if inotify is not available.
+    """
+    def __init__(self, paths):
+        self.fd = None
+        self.names = {}
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                return
+            self.fd = fd
+            for directory in sorted({os.path.dirname(p) for p in paths}):
+                wd = libc.inotify_add_watch(
+                    fd, directory.encode(), IN_CLOSE_WRITE | IN_DELETE
+                )
+                if wd >= 0:
+                    self.names[wd] = {os.path.basename(p) for p in paths
+                                      if os.path.dirname(p) == directory}
+        except (OSError, AttributeError):
+            self.close()
+
+    def wait(self, timeout):
+        """
+        Blocks until a watched lock file is closed or timeout seconds passed.
+        Returns True if a relevant event was seen.
+        """
+        if self.fd is None:
+            time.sleep(max(0, timeout))
+            return False
+        end = time.monotonic() + timeout
+        while True:
+            remaining = end - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([self.fd], [], [], remaining)
+            if not readable:
+                return False
+            if self._drain():
+                return True
+
+    def _drain(self):
+        # Reads all pending events and reports whether one concerned a lock file
+        relevant = False
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return False
+        offset = 0
+        while offset + _EVENT_HEADER.size <= len(data):
+            wd, _, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip(b"\0").decode(errors="replace")
+            offset += length
+            if name in self.names.get(wd, ()):
+                relevant = True
+        return relevant
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def wait_for_locks(paths, deadline):
+    """
+    Waits until none of the given lock files is held, or until the monotonic deadline.
+    Returns (free, waited_seconds, holders) where holders lists every
+    (path, pid, name) that was seen holding a lock while waiting.
+    """
+    start = time.monotonic()
+    seen = []
+    holders = find_lock_holders(paths)
+    if not holders:
+        return True, 0.0, seen
+
+    watcher = LockWatcher(paths)
+    try:
+        while holders:
+            for holder in holders:
+                if holder not in seen:
+                    seen.append(holder)
+                    print(f"Waiting for {holder[0]} held by {holder[2]} (pid {holder[1]})",
+                          file=sys.stderr)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False, time.monotonic() - start, seen
+            watcher.wait(min(remaining, RECHECK_INTERVAL))
+            holders = find_lock_holders(paths)
+    finally:
+        watcher.close()
+    return True, time.monotonic() - start, seen
+
+
+def apt_args(cmd, seconds):
+    """
+    Lets apt itself wait for the frontend lock for the remaining time,
+    which covers the short race between our check and apt taking the lock.
+    """
+    if cmd and os.path.basename(cmd[0]) in ("apt", "apt-get"):
+        return [cmd[0], "-o", f"DPkg::Lock::Timeout={max(0, int(seconds))}"] + cmd[1:]
+    return cmd
+
+
+def live_steps(plan):
+    """
+    Returns the steps installing the live-safe part of an install plan
+    (apt and the system Flatpak installation). The install steps carry the
+    plan key ('apt' or 'flatpak') they install, see defer_failed.
+    """
+    steps = []
+    if plan["apt_live"]:
+        # 'apt-get install' marks packages as manually installed, so restore the auto flags afterwards
+        auto = sorted(install_plan.auto_installed_packages() & set(plan["apt_live"]))
+        steps.append({"cmd": ["apt-get", "install", "--only-upgrade", "-y", *plan["apt_live"]],
+                      "locks": DPKG_LOCKS, "prefetch": True, "installs": "apt"})
+        if auto:
+            steps.append({"cmd": ["apt-mark", "auto", *auto], "locks": DPKG_LOCKS})
+    system_refs = [ref for installation, ref in plan["flatpak_live"] if installation == "system"]
+    if system_refs:
+        steps.append({"cmd": ["flatpak", "update", "--system", "-y", "--noninteractive", *system_refs],
+                      "locks": [], "installs": "flatpak"})
+    return steps
+
+
+def defer_failed(plan, failed):
+    """
+    Moves the live-safe part of every plan key in failed ('apt', 'flatpak')
+    to the deferred part, so those updates are still offered later.
+    """
+    for key in failed:
+        plan[f"{key}_deferred"] = plan[f"{key}_live"] + plan[f"{key}_deferred"]
+        plan[f"{key}_live"] = []
+    return plan
+
+
+def run_steps(steps, timeout, peers=()):
+    """
+    Runs the steps in order. Each step is a dict with 'cmd' (argument list)
+    and 'locks' (lock files it needs). All steps share a lock wait budget of
+    timeout seconds; only time spent waiting for locks counts against it, not
+    the time the steps run. A step whose locks are not released within the
+    remaining budget is skipped; the remaining steps still run.
+    For steps with 'prefetch' set, the packages are first fetched from the peer caches (see peer_cache.py).
+    A {"plan": "live"} step is replaced by the live-safe steps (see live_steps).
+    Returns a result dict with the outcome of every step, the total lock wait time,
+    what came from peers and the install plan, if one was made. Updates whose
+    install step did not succeed count as deferred in that plan.
+    """
+    budget = timeout
+    results = []
+    total_wait = 0.0
+    from_peers = {"files": 0, "bytes": 0}
+    plan = None
+    failed = set()
+    steps = list(steps)
+    while steps:
+        step = steps.pop(0)
+        if step.get("plan") == "live":
+            plan = install_plan.plan_install(installations=("system",))
+            print(f"Live-safe: {len(plan['apt_live'])} packages, {len(plan['flatpak_live'])} Flatpaks; "
+                  f"deferred: {len(plan['apt_deferred'])} packages, {len(plan['flatpak_deferred'])} Flatpaks.",
+                  file=sys.stderr)
+            steps[0:0] = live_steps(plan)
+            continue
+        cmd = step["cmd"]
+        free, waited, holders = wait_for_locks(step.get("locks", []), time.monotonic() + budget)
+        total_wait += waited
+        budget = max(0.0, budget - waited)
+        entry = {
+            "cmd": cmd,
+            "lock_wait_seconds": round(waited, 3),
+            "holders": [name for _, _, name in holders],
+        }
+        if not free:
+            print(f"Skipping '{' '.join(cmd)}': locks still held, lock wait budget used up", file=sys.stderr)
+            entry["status"] = "lock-timeout"
+            results.append(entry)
+            if step.get("installs"):
+                failed.add(step["installs"])
+            continue
+        if peers and step.get("prefetch"):
+            try:
+                stats = peer_cache.prefetch(cmd, peers)
+                from_peers["files"] += stats["files"]
+                from_peers["bytes"] += stats["bytes"]
+            except OSError as e:
+                print("Fetching from peers failed:", e, file=sys.stderr)
+        cmd = apt_args(cmd, budget)
+        try:
+            # Child output goes to stderr so stdout only carries the result line
+            returncode = subprocess.run(cmd, stdout=sys.stderr).returncode
+        except OSError as e:
+            print(f"Could not run '{' '.join(cmd)}': {e}", file=sys.stderr)
+            returncode = 127
+        entry["status"] = "ok" if returncode == 0 else "failed"
+        entry["returncode"] = returncode
+        results.append(entry)
+        if returncode != 0 and step.get("installs"):
+            failed.add(step["installs"])
+    result = {"steps": results, "lock_wait_seconds": round(total_wait, 3), "from_peers": from_peers}
+    if plan is not None:
+        result["plan"] = defer_failed(plan, failed)
+    return result
+
+
+def main(argv):
+    """
+    Usage: apt_locks.py TIMEOUT_SECONDS STEPS_JSON [OPTIONS_JSON]
+    OPTIONS_JSON may contain
+      "mirrors": {"replace": [URIs], "mirrors": [ranked URLs]}, see mirrors.py
+      "peers": [peer cache base URLs], see peer_cache.py
+    Prints the result as a single line prefixed with RESULT_PREFIX.
+    """
+    if len(argv) not in (3, 4):
+        print(main.__doc__, file=sys.stderr)
+        return 2
+    timeout = float(argv[1])
+    steps = json.loads(argv[2])
+    options = json.loads(argv[3]) if len(argv) == 4 else {}
+    selection = options.get("mirrors")
+    if selection:
+        try:
+            mirrors.apply_mirror_list(selection["replace"], selection["mirrors"])
+        except OSError as e:
+            print("Could not update the mirror list, using the sources as they are:", e, file=sys.stderr)
+    else:
+        # Fewer than two candidates configured (any more): back to the original sources
+        try:
+            mirrors.restore_sources()
+        except OSError as e:
+            print("Could not restore the original sources:", e, file=sys.stderr)
+    peers = [p for p in options.get("peers", []) if p.startswith("http://")]
+    result = run_steps(steps, timeout, peers)
+    print(RESULT_PREFIX + json.dumps(result), flush=True)
+    failed = any(step["status"] != "ok" for step in result["steps"])
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
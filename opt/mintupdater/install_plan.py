@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Splits pending updates into a live-safe set and a deferred set.
+
+Live-safe updates only touch files that no running process has executed or
+mapped, so they can be installed in the background during the session.
+Deferred updates would replace files that running applications use (or restart
+a system service from their maintainer scripts) and stay for the shutdown.
+
+  apt:     'apt-get -s upgrade' lists the packages, the dpkg file lists
+           (/var/lib/dpkg/info/*.list) say which files each package owns.
+  flatpak: 'flatpak remote-ls --updates' lists the refs, 'flatpak ps' and the
+           sandboxes' /.flatpak-info the running apps and the runtimes they use.
+
+The root runner (apt_locks.py) makes the final plan for apt and the system
+installation, because only root sees the processes of every user.
+"""
+import configparser
+import glob
+import os
+import subprocess
+
+import restart_check
+
+DPKG_INFO = "/var/lib/dpkg/info"
+
+# Packages shipping one of these get their service restarted by the maintainer scripts
+SERVICE_DIRS = ("/lib/systemd/system/", "/usr/lib/systemd/system/", "/etc/init.d/")
+
+# With merged /usr, dpkg may list /lib/... while /proc shows /usr/lib/...
+MERGED_DIRS = ("/bin/", "/sbin/", "/lib/", "/lib32/", "/lib64/", "/libx32/")
+
+
+def canonical(path):
+    for prefix in MERGED_DIRS:
+        if path.startswith(prefix) and os.path.islink(prefix.rstrip("/")):
+            return "/usr" + path
+    return path
+
+
+def run_output(cmd):
+    # Returns the standard output of a command, or '' if it is not installed
+    try:
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    except OSError:
+        return ""
+    return result.stdout
+
+
+def pending_apt_packages():
+    """
+    Returns the names of installed packages that 'apt upgrade' would upgrade.
+    """
+    return simulate_apt(['upgrade', '--with-new-pkgs'], upgrades_only=True)
+
+
+def simulate_apt(args, upgrades_only=False):
+    """
+    Runs 'apt-get -s' with the given arguments and returns the packages it would install.
+    """
+    output = run_output(['apt-get', '-s', '-o', 'Debug::NoLocking=1', *args])
+    packages = []
+    for line in output.splitlines():
+        # "Inst name [old-version] (new-version ...)"; new packages have no [old-version]
+        if not line.startswith("Inst "):
+            continue
+        fields = line.split()
+        if upgrades_only and not (len(fields) > 2 and fields[2].startswith("[")):
+            continue
+        packages.append(fields[1])
+    return packages
+
+
+def package_files(package):
+    """
+    Returns the files installed by a package, from its dpkg file list.
+    """
+    files = set()
+    name = package.split(":")[0]
+    for path in glob.glob(os.path.join(DPKG_INFO, f"{name}.list")) + \
+            glob.glob(os.path.join(DPKG_INFO, f"{name}:*.list")):
+        try:
+            with open(path, "r", errors="replace") as f:
+                files.update(canonical(line.rstrip("\n")) for line in f)
+        except OSError:
+            continue
+    return files
+
+
+def auto_installed_packages():
+    """
+    Returns the set of packages marked as automatically installed.
+    """
+    output = run_output(['apt-mark', 'showauto'])
+    return set(output.split())
+
+
+def split_apt(packages, in_use):
+    """
+    Returns (live, deferred) lists of apt packages.
+    """
+    in_use = {canonical(path) for path in in_use}
+    live, deferred = [], []
+    for package in packages:
+        files = package_files(package)
+        if files & in_use or any(path.startswith(SERVICE_DIRS) for path in files):
+            deferred.append(package)
+        else:
+            live.append(package)
+
+    # A live package must not pull in a newer version of a deferred one
+    if live and deferred and set(simulate_apt(['install', '--only-upgrade', *live])) & set(deferred):
+        checked = []
+        for package in live:
+            if set(simulate_apt(['install', '--only-upgrade', package])) & set(deferred):
+                deferred.append(package)
+            else:
+                checked.append(package)
+        live = checked
+    return live, deferred
+
+
+def pending_flatpak_refs(installations=("system", "user")):
+    """
+    Returns a list of (installation, ref) with updates, installation being 'system' or 'user'.
+    """
+    refs = []
+    for installation in installations:
+        output = run_output(['flatpak', 'remote-ls', f'--{installation}', '--updates', '--columns=ref'])
+        refs += [(installation, line.strip()) for line in output.splitlines() if line.strip()]
+    return refs
+
+
+def running_flatpak_ids(proc="/proc"):
+    """
+    Returns the IDs of running Flatpak apps and of the runtimes they use.
+    'flatpak ps' only lists the caller's own instances, so the sandboxes of
+    all readable processes (every process when running as root) are read too.
+    """
+    output = run_output(['flatpak', 'ps', '--columns=application,runtime'])
+    ids = set()
+    for line in output.splitlines():
+        for field in line.split():
+            ids.add(field.split("/")[0])
+    for entry in os.scandir(proc):
+        if not entry.name.isdigit():
+            continue
+        info = configparser.ConfigParser(interpolation=None)
+        try:
+            info.read_string(restart_check.read_file(f"{proc}/{entry.name}/root/.flatpak-info")
+                             .decode(errors="replace"))
+        except (OSError, configparser.Error):
+            continue
+        name = info.get("Application", "name", fallback=None)
+        if name:
+            ids.add(name)
+        # runtime=runtime/org.freedesktop.Platform/x86_64/23.08
+        runtime = info.get("Application", "runtime", fallback="").split("/")
+        if len(runtime) > 1:
+            ids.add(runtime[1])
+    return ids
+
+
+def split_flatpak(refs, running):
+    """
+    Returns (live, deferred) lists of (installation, ref).
+    Extensions such as .Locale or .GL.default follow their app or runtime.
+    """
+    live, deferred = [], []
+    for installation, ref in refs:
+        parts = ref.split("/")
+        ref_id = parts[1] if len(parts) > 1 else ref
+        if any(ref_id == r or ref_id.startswith(r + ".") for r in running):
+            deferred.append((installation, ref))
+        else:
+            live.append((installation, ref))
+    return live, deferred
+
+
+def plan_install(installations=("system", "user")):
+    """
+    Returns the install plan: {'apt_live', 'apt_deferred', 'flatpak_live', 'flatpak_deferred'}.
+    Only the given Flatpak installations are looked at.
+    """
+    in_use = restart_check.in_use_files()
+    apt_live, apt_deferred = split_apt(pending_apt_packages(), in_use)
+    flatpak_live, flatpak_deferred = split_flatpak(pending_flatpak_refs(installations),
+                                                   running_flatpak_ids())
+    return {
+        "apt_live": apt_live,
+        "apt_deferred": apt_deferred,
+        "flatpak_live": flatpak_live,
+        "flatpak_deferred": flatpak_deferred,
+    }
+
+
+if __name__ == "__main__":
+    for key, value in plan_install().items():
+        print(f"{key}: {' '.join(v if isinstance(v, str) else v[1] for v in value) or '-'}")
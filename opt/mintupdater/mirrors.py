@@ -0,0 +1,292 @@
+#!/usr/bin/env python3
+"""
+Measured mirror selection for apt work.
+
+The user side (update_checker.py) ranks the configured candidate mirrors by
+fetching the first PROBE_BYTES of a small fixed file (the suite's Release file)
+from all of them in parallel, and keeps the result for a while.
+The root side (apt_locks.py) writes the ranking to MIRROR_LIST and points the
+system's apt sources for the candidate URIs at it ('mirror+file:'), so apt uses
+the fastest mirror and falls back to the next one by itself if a mirror fails
+or stalls. The sources are changed once and then stay the same; later rankings
+only rewrite MIRROR_LIST. That way apt, mintupdate-cli, Synaptic and the Update
+Manager all use one source set and share the same index files.
+The original source lines are kept in SOURCES_BACKUP and put back when fewer
+than two candidates are configured (restore_sources) or the package is removed
+(see DEBIAN/postrm).
+
+Only the standard library is used, because this file also runs under pkexec.
+"""
+import glob
+import json
+import os
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+# Results of the last ranking
+CACHE_PATH = Path.home() / '.config/mintupdater/mirrors.json'
+
+# Apt sources of the system
+SOURCES_LIST = "/etc/apt/sources.list"
+SOURCES_PARTS = "/etc/apt/sources.list.d"
+
+# Ranked mirror list used by the sources (see apt-transport-mirror(1))
+MIRROR_LIST = "/var/lib/mintupdater/mirrors.txt"
+MIRROR_URI = "mirror+file:" + MIRROR_LIST
+
+# Original source lines, {file: {rewritten line: original line}}
+SOURCES_BACKUP = "/var/lib/mintupdater/sources.orig"
+
+# Probe settings
+PROBE_PATH = "dists/{suite}/Release"
+PROBE_BYTES = 65536
+PROBE_TIMEOUT = 5
+MAX_WORKERS = 8
+
+
+def normalize(url):
+    return url.rstrip('/') + '/'
+
+
+def parse_source_line(line):
+    """
+    Splits a one-line style apt source ('deb [opts] URI suite components...')
+    into (type, options, uri, rest) or returns None for comments and other lines.
+    """
+    parts = line.split('#', 1)[0].split()
+    if len(parts) < 3 or parts[0] not in ("deb", "deb-src"):
+        return None
+    kind, parts = parts[0], parts[1:]
+    options = []
+    if parts[0].startswith('['):
+        # Options may span several tokens: [arch=amd64 signed-by=...]
+        while parts:
+            options.append(parts.pop(0))
+            if options[-1].endswith(']'):
+                break
+    if len(parts) < 2:
+        return None
+    return kind, options, parts[0], parts[1:]
+
+
+def source_files(sources_list=SOURCES_LIST, sources_parts=SOURCES_PARTS):
+    files = [sources_list] if os.path.exists(sources_list) else []
+    files += sorted(glob.glob(os.path.join(sources_parts, "*.list")))
+    return files
+
+
+def find_suite(candidates, sources_list=SOURCES_LIST, sources_parts=SOURCES_PARTS):
+    """
+    Returns the first suite (e.g. 'jammy') used with one of the candidate mirrors
+    (or with the mirror list), or None.
+    """
+    wanted = {normalize(c) for c in candidates} | {normalize(MIRROR_URI)}
+    for path in source_files(sources_list, sources_parts):
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    parsed = parse_source_line(line)
+                    if parsed and normalize(parsed[2]) in wanted:
+                        return parsed[3][0]
+        except OSError:
+            continue
+    return None
+
+
+def probe_mirror(url, path, timeout=PROBE_TIMEOUT, probe_bytes=PROBE_BYTES):
+    """
+    Fetches the first probe_bytes of url + path.
+    Returns a dict with latency (time to first byte), throughput (bytes/s)
+    and whether the mirror is healthy. A mirror that errors or stalls
+    longer than timeout is unhealthy.
+    """
+    result = {"url": url, "healthy": False, "latency": None, "throughput": None}
+    request = urllib.request.Request(
+        normalize(url) + path,
+        headers={"Range": f"bytes=0-{probe_bytes - 1}", "User-Agent": "mintupdater"}
+    )
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            first = response.read(1)
+            latency = time.monotonic() - start
+            received = len(first)
+            while received < probe_bytes:
+                if time.monotonic() - start > timeout:
+                    raise TimeoutError("mirror stalled")
+                chunk = response.read(min(16384, probe_bytes - received))
+                if not chunk:
+                    break
+                received += len(chunk)
+        duration = max(time.monotonic() - start - latency, 1e-6)
+        result.update(healthy=received > 0, latency=round(latency, 4),
+                      throughput=round(received / duration))
+    except Exception as e:
+        result["error"] = str(e)
+    return result
+
+
+def score(result, probe_bytes=PROBE_BYTES):
+    # Estimated time to fetch a probe-sized file; lower is better
+    return result["latency"] + probe_bytes / max(result["throughput"], 1)
+
+
+def rank_mirrors(candidates, path, timeout=PROBE_TIMEOUT, probe_bytes=PROBE_BYTES):
+    """
+    Probes all candidates in parallel and returns the results,
+    healthy mirrors first (fastest first), unhealthy ones after them.
+    """
+    if not candidates:
+        return []
+    with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, len(candidates))) as pool:
+        results = list(pool.map(lambda url: probe_mirror(url, path, timeout, probe_bytes), candidates))
+    healthy = sorted((r for r in results if r["healthy"]), key=lambda r: score(r, probe_bytes))
+    return healthy + [r for r in results if not r["healthy"]]
+
+
+def load_ranking(candidates, max_age, cache_path=CACHE_PATH):
+    """
+    Returns the cached ranking if it is younger than max_age seconds
+    and was made for the same candidates, otherwise None.
+    """
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if sorted(cached.get("candidates", [])) != sorted(candidates):
+        return None
+    if time.time() - cached.get("time", 0) > max_age:
+        return None
+    return cached["results"]
+
+
+def save_ranking(candidates, results, cache_path=CACHE_PATH):
+    os.makedirs(Path(cache_path).parent, exist_ok=True)
+    with open(cache_path, 'w') as f:
+        json.dump({"time": time.time(), "candidates": candidates, "results": results}, f)
+
+
+def get_ranked_mirrors(candidates, max_age, path=None, force=False, cache_path=CACHE_PATH):
+    """
+    Returns the candidate URLs ordered fastest first, using the cached ranking
+    while it is valid. Unhealthy mirrors stay at the end as a last resort.
+    """
+    if len(candidates) < 2:
+        return list(candidates)
+    results = None if force else load_ranking(candidates, max_age, cache_path)
+    if results is None:
+        if path is None:
+            suite = find_suite(candidates)
+            if suite is None:
+                return list(candidates)
+            path = PROBE_PATH.format(suite=suite)
+        results = rank_mirrors(candidates, path)
+        save_ranking(candidates, results, cache_path)
+        for r in results:
+            print(f"Mirror {r['url']}: healthy={r['healthy']} latency={r['latency']} "
+                  f"throughput={r['throughput']}")
+    return [r["url"] for r in results]
+
+
+def write_if_changed(path, content):
+    """
+    Atomically replaces a file if its content differs, keeping its permissions.
+    Returns True if the file was written.
+    """
+    try:
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+        mode = os.stat(path).st_mode & 0o777
+    except FileNotFoundError:
+        mode = 0o644
+    temp = path + ".mintupdater-new"
+    with open(temp, 'w') as f:
+        f.write(content)
+    os.chmod(temp, mode)
+    os.replace(temp, path)
+    return True
+
+
+def load_backup(backup=SOURCES_BACKUP):
+    try:
+        with open(backup, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def apply_mirror_list(replace, mirrors, mirror_list=MIRROR_LIST,
+                      sources_list=SOURCES_LIST, sources_parts=SOURCES_PARTS,
+                      backup=SOURCES_BACKUP):
+    """
+    Root side: writes the ranked mirrors to mirror_list and points every
+    one-line source using a URI from replace at it. The system sources are
+    changed in place, so every apt frontend keeps seeing the same sources
+    and apt never cleans up index files of a source set it does not know.
+    Every replaced line is recorded in backup before the sources are written.
+    Returns True if any source uses the mirror list.
+    """
+    replace = {normalize(u) for u in replace}
+    mirrors = [normalize(m) for m in mirrors if m.startswith(("http://", "https://"))]
+    if not replace or not mirrors:
+        return False
+
+    os.makedirs(os.path.dirname(mirror_list), exist_ok=True)
+    write_if_changed(mirror_list, "".join(
+        f"{mirror}\tpriority:{priority}\n" for priority, mirror in enumerate(mirrors, start=1)
+    ))
+
+    mirror_uri = "mirror+file:" + mirror_list
+    originals = load_backup(backup)
+    used = False
+    for path in source_files(sources_list, sources_parts):
+        lines = []
+        with open(path, 'r') as f:
+            for line in f:
+                original = originals.get(path, {}).get(line.rstrip("\n"))
+                if original is not None and normalize(parse_source_line(original)[2]) not in replace:
+                    # No longer a candidate, back to the original mirror
+                    line = original + "\n"
+                parsed = parse_source_line(line)
+                if parsed and normalize(parsed[2]) in replace:
+                    kind, options, _, rest = parsed
+                    original = line.rstrip("\n")
+                    line = " ".join([kind] + options + [mirror_uri] + rest) + "\n"
+                    originals.setdefault(path, {}).setdefault(line.rstrip("\n"), original)
+                    parsed = parse_source_line(line)
+                if parsed and normalize(parsed[2]) == normalize(mirror_uri):
+                    used = True
+                lines.append(line)
+        if path in originals:
+            write_if_changed(backup, json.dumps(originals, indent=1) + "\n")
+        if write_if_changed(path, "".join(lines)):
+            print(f"Updated the mirror sources in {path}")
+    return used
+
+
+def restore_sources(mirror_list=MIRROR_LIST, backup=SOURCES_BACKUP):
+    """
+    Root side: puts the source lines replaced by apply_mirror_list back
+    and removes the mirror list and the backup. Lines the administrator
+    changed since then are left alone.
+    Returns True if anything was restored.
+    """
+    originals = load_backup(backup)
+    for path, lines in originals.items():
+        try:
+            with open(path, 'r') as f:
+                content = [lines.get(line.rstrip("\n"), line.rstrip("\n")) + "\n" for line in f]
+        except FileNotFoundError:
+            continue
+        if write_if_changed(path, "".join(content)):
+            print(f"Restored the original sources in {path}")
+    for path in (backup, mirror_list):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+    return bool(originals)
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+"""
+Peer package cache for machines on the same LAN.
+
+Every daemon with 'peer_cache' enabled serves the .deb files of its apt
+archive cache read-only over HTTP and answers discovery queries sent to a
+multicast group with its port and the number of packages it has.
+Before apt downloads packages, the root runner (apt_locks.py) asks the peers
+for the missing files, checks each one against the size and hash from the
+signed apt indexes (apt-get --print-uris) and puts verified files into the
+archive cache. Whatever no peer has is downloaded by apt from the mirror as usual.
+
+Only the standard library is used, because this file also runs under pkexec.
+"""
+import hashlib
+import json
+import os
+import socket
+import struct
+import subprocess
+import threading
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ARCHIVES_DIR = "/var/cache/apt/archives"
+
+DEFAULT_PORT = 47801
+DISCOVERY_GROUP = "239.255.42.99"
+DISCOVERY_PORT = 47802
+DISCOVERY_TIMEOUT = 1.0
+MAGIC = "mintupdater-peer-cache/1"
+
+FETCH_TIMEOUT = 10
+
+# Longest pause after repeated socket errors while answering discovery queries
+MAX_ERROR_BACKOFF = 60
+MAX_FETCH_WORKERS = 4
+
+
+def cached_debs(archives_dir=ARCHIVES_DIR):
+    """
+    Returns {filename: size} of the complete .deb files in the archive cache.
+    """
+    debs = {}
+    try:
+        for entry in os.scandir(archives_dir):
+            if entry.name.endswith(".deb") and entry.is_file():
+                debs[entry.name] = entry.stat().st_size
+    except OSError:
+        pass
+    return debs
+
+
+class PeerCacheHandler(BaseHTTPRequestHandler):
+    """
+    GET /apt/<file>.deb  a package from the archive cache
+    GET /index           JSON {filename: size} of all cached packages
+    """
+    server_version = "mintupdater-peer-cache"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path = urllib.parse.unquote(urllib.parse.urlsplit(self.path).path)
+        if path == "/index":
+            body = json.dumps(cached_debs(self.server.archives_dir)).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        name = path[len("/apt/"):] if path.startswith("/apt/") else ""
+        # Only plain .deb file names, nothing outside the archive cache
+        if not name.endswith(".deb") or "/" in name or name.startswith("."):
+            self.send_error(404)
+            return
+        try:
+            f = open(os.path.join(self.server.archives_dir, name), "rb")
+        except OSError:
+            self.send_error(404)
+            return
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            self.send_response(200)
+            self.send_header("Content-Type", "application/vnd.debian.binary-package")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            try:
+                while True:
+                    chunk = f.read(1 << 16)
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+
+class PeerCache:
+    """
+    Serves the local archive cache and answers discovery queries.
+    """
+    def __init__(self, port=DEFAULT_PORT, host="", archives_dir=ARCHIVES_DIR,
+                 discovery_group=DISCOVERY_GROUP, discovery_port=DISCOVERY_PORT):
+        self.httpd = ThreadingHTTPServer((host, port), PeerCacheHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.archives_dir = archives_dir
+        self.port = self.httpd.server_address[1]
+        self.archives_dir = archives_dir
+        self.discovery_group = discovery_group
+        self.discovery_port = discovery_port
+        self.sock = None
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        try:
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if hasattr(socket, "SO_REUSEPORT"):
+                self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.sock.bind(("", self.discovery_port))
+            membership = struct.pack("4sl", socket.inet_aton(self.discovery_group), socket.INADDR_ANY)
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+        except OSError as e:
+            print("Peer cache discovery not available:", e)
+            return self
+        threading.Thread(target=self._answer_queries, daemon=True).start()
+        return self
+
+    def _answer_queries(self):
+        # Tells every asking peer where we serve and how many packages we have
+        backoff = 1
+        while True:
+            sock = self.sock
+            if sock is None:
+                return
+            try:
+                data, address = sock.recvfrom(2048)
+                query = json.loads(data)
+                if not isinstance(query, dict) or query.get("magic") != MAGIC \
+                        or query.get("type") != "query":
+                    continue
+                offer = {"magic": MAGIC, "type": "offer", "port": self.port,
+                         "debs": len(cached_debs(self.archives_dir))}
+                sock.sendto(json.dumps(offer).encode(), address)
+                backoff = 1
+            except ValueError:
+                continue
+            except OSError as e:
+                if self.sock is None:
+                    return
+                # Do not spin on a socket that keeps failing
+                print("Peer cache discovery error:", e)
+                time.sleep(backoff)
+                backoff = min(backoff * 2, MAX_ERROR_BACKOFF)
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        if self.sock is not None:
+            sock, self.sock = self.sock, None
+            try:
+                # Wakes up the thread blocked in recvfrom
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            sock.close()
+
+
+def discover_peers(timeout=DISCOVERY_TIMEOUT, group=DISCOVERY_GROUP, port=DISCOVERY_PORT):
+    """
+    Asks the LAN for peer caches and returns their base URLs,
+    peers with the most cached packages first.
+    """
+    offers = {}
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP) as sock:
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            sock.sendto(json.dumps({"magic": MAGIC, "type": "query"}).encode(), (group, port))
+            end = time.monotonic() + timeout
+            while True:
+                remaining = end - time.monotonic()
+                if remaining <= 0:
+                    break
+                sock.settimeout(remaining)
+                try:
+                    data, (host, _) = sock.recvfrom(2048)
+                    offer = json.loads(data)
+                except (socket.timeout, ValueError):
+                    continue
+                if offer.get("magic") == MAGIC and offer.get("type") == "offer" and offer.get("debs"):
+                    offers[f"http://{host}:{int(offer['port'])}"] = offer["debs"]
+    except OSError as e:
+        print("Peer discovery failed:", e)
+    return sorted(offers, key=offers.get, reverse=True)
+
+
+def needed_downloads(cmd):
+    """
+    Returns [(filename, size, hash_type, hex_digest)] of the packages an apt
+    command would download, with the hashes from the signed indexes.
+    """
+    result = subprocess.run(
+        [cmd[0], "--print-uris", "-qq", *cmd[1:]],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        text=True
+    )
+    downloads = []
+    for line in result.stdout.splitlines():
+        # 'URI' filename size HASHTYPE:digest
+        fields = line.split()
+        if len(fields) < 4 or not fields[0].startswith("'") or ":" not in fields[3]:
+            continue
+        hash_type, digest = fields[3].split(":", 1)
+        hash_type = {"MD5Sum": "md5"}.get(hash_type, hash_type.lower())
+        if hash_type not in hashlib.algorithms_available:
+            continue
+        downloads.append((fields[1], int(fields[2]), hash_type, digest.lower()))
+    return downloads
+
+
+def fetch_from_peers(filename, size, hash_type, digest, peers, archives_dir=ARCHIVES_DIR):
+    """
+    Tries the peers in order and stores the first copy whose size and hash match.
+    Returns the peer it came from, or None.
+    """
+    target = os.path.join(archives_dir, filename)
+    temp = os.path.join(archives_dir, "partial", filename + ".peer")
+    os.makedirs(os.path.dirname(temp), exist_ok=True)
+    for peer in peers:
+        url = f"{peer}/apt/{urllib.parse.quote(filename)}"
+        try:
+            h = hashlib.new(hash_type)
+            received = 0
+            with urllib.request.urlopen(url, timeout=FETCH_TIMEOUT) as response, open(temp, "wb") as out:
+                while received <= size:
+                    chunk = response.read(1 << 16)
+                    if not chunk:
+                        break
+                    h.update(chunk)
+                    out.write(chunk)
+                    received += len(chunk)
+            if received != size or h.hexdigest() != digest:
+                print(f"Peer {peer} sent a bad copy of {filename}, ignoring it")
+                continue
+            os.chmod(temp, 0o644)
+            os.replace(temp, target)
+            return peer
+        except OSError:
+            continue
+        finally:
+            if os.path.exists(temp):
+                os.unlink(temp)
+    return None
+
+
+def prefetch(cmd, peers, archives_dir=ARCHIVES_DIR):
+    """
+    Fills the archive cache with the packages the apt command needs from the peers.
+    Returns {'files': number fetched from peers, 'bytes': their total size}.
+    """
+    stats = {"files": 0, "bytes": 0}
+    if not peers:
+        return stats
+    have = cached_debs(archives_dir)
+    missing = [d for d in needed_downloads(cmd) if have.get(d[0]) != d[1]]
+    if not missing:
+        return stats
+    with ThreadPoolExecutor(max_workers=MAX_FETCH_WORKERS) as pool:
+        sources = list(pool.map(lambda d: fetch_from_peers(*d, peers, archives_dir), missing))
+    for (filename, size, _, _), source in zip(missing, sources):
+        if source is not None:
+            stats["files"] += 1
+            stats["bytes"] += size
+    return stats
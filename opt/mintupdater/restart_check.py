@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+"""
+Finds running processes that still use files replaced by an update.
+
+After packages are upgraded, programs that were already running keep the
+old binaries and libraries mapped. Their executable mappings show up in
+/proc/PID/maps as '(deleted)' or with an inode that no longer matches the file
+on disk. Data mappings (locale archives, fonts, caches) are not counted, since
+a process using an old copy of those does not run old code.
+Instead of asking for a full reboot, the affected processes are mapped to
+desktop applications and services so the user can restart just those.
+
+Each maps file is read once, the check of a mapped file is cached by
+(device, inode, path) since most libraries are shared by many processes,
+and kernel threads (no /proc/PID/exe) are skipped.
+"""
+import glob
+import os
+import sys
+
+# Only files below these directories are program code that updates replace
+CODE_PREFIXES = (b"/usr/", b"/lib", b"/bin/", b"/sbin/", b"/opt/")
+
+DELETED_SUFFIX = b" (deleted)"
+
+# Desktop files used to turn executables into application names
+DESKTOP_DIRS = [
+    "/usr/share/applications",
+    "/usr/local/share/applications",
+    "/var/lib/flatpak/exports/share/applications",
+    os.path.expanduser("~/.local/share/applications"),
+    os.path.expanduser("~/.local/share/flatpak/exports/share/applications"),
+]
+
+
+def read_file(path):
+    # Reads a whole /proc file with as few syscalls as possible
+    fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+    try:
+        chunks = []
+        while True:
+            chunk = os.read(fd, 1 << 20)
+            if not chunk:
+                return b"".join(chunks)
+            chunks.append(chunk)
+    finally:
+        os.close(fd)
+
+
+class StaleFileCache:
+    """
+    Remembers for every mapped (device, inode, path) whether it was replaced on disk.
+    """
+    def __init__(self):
+        self.cache = {}
+
+    def is_stale(self, dev, inode, path):
+        key = (dev, inode, path)
+        stale = self.cache.get(key)
+        if stale is None:
+            try:
+                st = os.stat(path)
+                stale = st.st_ino != inode
+            except OSError:
+                stale = True
+            self.cache[key] = stale
+        return stale
+
+
+def parse_dev(field):
+    major, minor = field.split(b":")
+    return int(major, 16), int(minor, 16)
+
+
+def stale_files_of(pid, cache, same_mount_ns):
+    """
+    Returns the set of replaced or deleted code files mapped by a process.
+    For processes in another mount namespace (e.g. Flatpak) paths cannot be
+    compared with the host, so only '(deleted)' mappings are reported.
+    """
+    stale = set()
+    seen = set()
+    for line in read_file(f"/proc/{pid}/maps").splitlines():
+        # address perms offset dev inode path
+        fields = line.split(None, 5)
+        if len(fields) < 6 or b"x" not in fields[1]:
+            continue
+        path = fields[5]
+        if path in seen:
+            continue
+        seen.add(path)
+        deleted = path.endswith(DELETED_SUFFIX)
+        if deleted:
+            path = path[:-len(DELETED_SUFFIX)]
+        if not path.startswith(CODE_PREFIXES):
+            continue
+        if deleted:
+            stale.add(path.decode(errors="replace"))
+        elif same_mount_ns:
+            name = path.decode(errors="replace")
+            if cache.is_stale(parse_dev(fields[3]), int(fields[4]), name):
+                stale.add(name)
+    return stale
+
+
+def find_stale_processes(proc="/proc"):
+    """
+    Scans all readable processes and returns {pid: (exe, set of stale files)}
+    for those that use replaced files. Processes of other users are only
+    visible when running as root.
+    """
+    cache = StaleFileCache()
+    try:
+        own_ns = os.readlink(f"{proc}/self/ns/mnt")
+    except OSError:
+        own_ns = None
+    result = {}
+    for entry in os.scandir(proc):
+        if not entry.name.isdigit():
+            continue
+        pid = int(entry.name)
+        try:
+            # Kernel threads have no exe, other users' processes are not readable
+            exe = os.readlink(f"{proc}/{pid}/exe")
+            same_ns = own_ns is not None and os.readlink(f"{proc}/{pid}/ns/mnt") == own_ns
+            files = stale_files_of(pid, cache, same_ns)
+        except OSError:
+            continue
+        if exe.endswith(" (deleted)"):
+            exe = exe[:-len(" (deleted)")]
+            files.add(exe)
+        if files:
+            result[pid] = (exe, files)
+    return result
+
+
+def script_files(pid, proc="/proc"):
+    """
+    Returns the code files a process uses without mapping them: scripts named
+    on its command line (python3 /usr/lib/.../tool.py) and files it has open.
+    """
+    files = set()
+    cwd = os.readlink(f"{proc}/{pid}/cwd")
+    for arg in read_file(f"{proc}/{pid}/cmdline").split(b"\0")[1:]:
+        if not arg or arg.startswith(b"-"):
+            continue
+        path = os.path.normpath(os.path.join(cwd.encode(), arg))
+        if path.startswith(CODE_PREFIXES) and os.path.isfile(path):
+            files.add(path.decode(errors="replace"))
+    try:
+        fds = os.listdir(f"{proc}/{pid}/fd")
+    except OSError:
+        return files
+    for fd in fds:
+        try:
+            path = os.readlink(f"{proc}/{pid}/fd/{fd}")
+        except OSError:
+            continue
+        if path.encode().startswith(CODE_PREFIXES) and os.path.isfile(path):
+            files.add(path)
+    return files
+
+
+def in_use_files(proc="/proc"):
+    """
+    Returns the set of code files currently executed or mapped executable by any readable
+    process in our mount namespace, plus the scripts interpreters run and the files
+    processes have open (used to plan which updates are safe to apply now).
+    """
+    try:
+        own_ns = os.readlink(f"{proc}/self/ns/mnt")
+    except OSError:
+        return set()
+    files = set()
+    for entry in os.scandir(proc):
+        if not entry.name.isdigit():
+            continue
+        try:
+            files.add(os.readlink(f"{proc}/{entry.name}/exe"))
+            if os.readlink(f"{proc}/{entry.name}/ns/mnt") != own_ns:
+                continue
+            maps = read_file(f"{proc}/{entry.name}/maps")
+            files |= script_files(entry.name, proc)
+        except OSError:
+            continue
+        for line in maps.splitlines():
+            fields = line.split(None, 5)
+            if len(fields) == 6 and b"x" in fields[1] and fields[5].startswith(CODE_PREFIXES):
+                files.add(fields[5].decode(errors="replace"))
+    return files
+
+
+def unit_of(pid):
+    """
+    Returns (kind, name) from the process's systemd cgroup:
+    ('service', 'cups.service'), ('flatpak', 'org.mozilla.firefox') or (None, None).
+    """
+    try:
+        with open(f"/proc/{pid}/cgroup", "r") as f:
+            cgroup = f.read().strip().rsplit("/", 1)[-1]
+    except OSError:
+        return None, None
+    if cgroup.startswith("app-flatpak-") and cgroup.endswith(".scope"):
+        return "flatpak", cgroup[len("app-flatpak-"):-len(".scope")].rsplit("-", 1)[0]
+    if cgroup.endswith(".service") and not cgroup.startswith("app-"):
+        return "service", cgroup
+    return None, None
+
+
+def desktop_names(dirs=DESKTOP_DIRS):
+    """
+    Returns {executable basename or desktop id: application name} from the desktop files.
+    """
+    names = {}
+    for directory in dirs:
+        for path in glob.glob(os.path.join(directory, "*.desktop")):
+            name = exe = None
+            try:
+                with open(path, "r", errors="replace") as f:
+                    for line in f:
+                        if line.startswith("[") and line.strip() != "[Desktop Entry]":
+                            break
+                        if line.startswith("Name=") and name is None:
+                            name = line[5:].strip()
+                        elif line.startswith("Exec=") and exe is None:
+                            exe = line[5:].split()[0] if line[5:].split() else None
+            except OSError:
+                continue
+            if name is None:
+                continue
+            names.setdefault(os.path.basename(path)[:-len(".desktop")], name)
+            if exe:
+                names.setdefault(os.path.basename(exe), name)
+    return names
+
+
+def stale_applications(stale=None):
+    """
+    Groups the processes using replaced files into applications and services.
+    Returns a list of dicts with 'name', 'kind' ('app', 'service' or 'process'),
+    'pids' and 'files', sorted by kind and name.
+    """
+    if stale is None:
+        stale = find_stale_processes()
+    if not stale:
+        return []
+    names = desktop_names()
+    groups = {}
+    for pid, (exe, files) in stale.items():
+        kind, unit = unit_of(pid)
+        if kind == "service":
+            key = ("service", unit)
+        elif kind == "flatpak":
+            key = ("app", names.get(unit, unit))
+        elif os.path.basename(exe) in names:
+            key = ("app", names[os.path.basename(exe)])
+        else:
+            key = ("process", os.path.basename(exe))
+        group = groups.setdefault(key, {"name": key[1], "kind": key[0], "pids": [], "files": set()})
+        group["pids"].append(pid)
+        group["files"].update(files)
+    order = {"app": 0, "service": 1, "process": 2}
+    return sorted(groups.values(), key=lambda g: (order[g["kind"]], g["name"].lower()))
+
+
+if __name__ == "__main__":
+    for group in stale_applications():
+        print(f"{group['kind']}: {group['name']} (pids {', '.join(map(str, sorted(group['pids'])))})")
+    sys.exit(0)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+"""
+Small resident shutdown watcher for the on-demand mode.
+
+Holds the shutdown delay inhibitor and waits for PrepareForShutdown.
+The full UI process (update_checker.py --activated) is only started via
+D-Bus activation when a shutdown actually happens; the inhibitor is
+released as soon as it answers.
+Deliberately does not import GTK to keep the resident footprint small.
+"""
+import json
+import os
+import sys
+from pathlib import Path
+import dbus
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+# D-Bus name of the UI process (see update_checker.py)
+BUS_NAME = "org.mintupdater.Updater"
+OBJECT_PATH = "/org/mintupdater/Updater"
+INTERFACE = "org.mintupdater.Updater"
+
+# Path to the configuration file in the user's home directory
+CONFIG_PATH = Path.home() / '.config/mintupdater/config.json'
+
+# System default mode (see update_checker.get_mode)
+SYSTEM_MODE_PATH = Path("/etc/mintupdater/mode")
+MODE_ON_DEMAND = "on-demand"
+
+# Used if InhibitDelayMaxUSec cannot be read
+FALLBACK_DELAY_SECONDS = 36000
+
+dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+
+
+class ShutdownWatcher:
+    """
+    Keeps a delay inhibitor and hands the shutdown over to the UI process.
+    """
+    def __init__(self):
+        self.system_bus = dbus.SystemBus()
+        self.session_bus = dbus.SessionBus()
+        proxy = self.system_bus.get_object("org.freedesktop.login1", "/org/freedesktop/login1")
+        self.manager = dbus.Interface(proxy, "org.freedesktop.login1.Manager")
+        self.properties = dbus.Interface(proxy, "org.freedesktop.DBus.Properties")
+        self.inhibitor_fd = None
+        self.inhibit()
+        self.system_bus.add_signal_receiver(
+            self.on_prepare_for_shutdown, signal_name="PrepareForShutdown",
+            dbus_interface="org.freedesktop.login1.Manager", path="/org/freedesktop/login1")
+
+    def inhibit(self):
+        # Takes the delay inhibitor (again), e.g. after a cancelled shutdown
+        if self.inhibitor_fd is not None:
+            return
+        fd_raw = self.manager.Inhibit("shutdown", "Mintupdater", "Updates pending", "delay")
+        self.inhibitor_fd = os.fdopen(fd_raw.take(), 'w')
+        print("Shutdown inhibited.")
+
+    def release(self):
+        if self.inhibitor_fd is not None:
+            self.inhibitor_fd.close()
+            self.inhibitor_fd = None
+            print("Shutdown released.")
+
+    def get_inhibit_delay(self):
+        try:
+            usec = self.properties.Get("org.freedesktop.login1.Manager", "InhibitDelayMaxUSec")
+            return int(usec) // 1_000_000
+        except dbus.DBusException as e:
+            print("Error reading InhibitDelayMaxUSec:", e)
+            return FALLBACK_DELAY_SECONDS
+
+    def on_prepare_for_shutdown(self, starting):
+        if not starting:
+            # Shutdown was cancelled, be ready for the next one
+            self.inhibit()
+            return
+        if self.inhibitor_fd is None:
+            return
+        print("Shutdown started, activating the update UI...")
+
+        def on_reply():
+            self.release()
+
+        def on_error(e):
+            print("Update UI failed:", e)
+            self.release()
+
+        try:
+            proxy = self.session_bus.get_object(BUS_NAME, OBJECT_PATH)
+            dbus.Interface(proxy, INTERFACE).HandleShutdown(
+                reply_handler=on_reply, error_handler=on_error,
+                timeout=self.get_inhibit_delay())
+        except dbus.DBusException as e:
+            on_error(e)
+
+
+def get_mode(config):
+    # Same lookup as update_checker.get_mode, without importing GTK
+    mode = config.get("mode")
+    if mode is None:
+        try:
+            mode = SYSTEM_MODE_PATH.read_text().strip()
+        except OSError:
+            mode = None
+    return mode
+
+
+def main():
+    try:
+        with open(CONFIG_PATH, 'r') as f:
+            config = json.load(f)
+    except (OSError, ValueError):
+        config = {}
+    # In resident mode update_checker.py holds the inhibitor itself
+    if get_mode(config) != MODE_ON_DEMAND:
+        print("Not in on-demand mode, exiting.")
+        return
+
+    try:
+        ShutdownWatcher()
+    except Exception as e:
+        print("Error setting shutdown inhibit:", e)
+        sys.exit(1)
+
+    # The watcher is the resident process in on-demand mode, so it serves the peer cache
+    if config.get("peer_cache", False):
+        # Imported here so the watcher stays small when the peer cache is off
+        import peer_cache
+        try:
+            cache = peer_cache.PeerCache(port=config.get("peer_cache_port", peer_cache.DEFAULT_PORT)).start()
+        except OSError as e:
+            print("Could not start the peer cache:", e)
+
+    GLib.MainLoop().run()
+
+
+if __name__ == "__main__":
+    main()
@@ -12,9 +12,17 @@ import sys
 from pathlib import Path
 import dbus
 import dbus.mainloop.glib
+import dbus.service
 from datetime import datetime
+from apt_locks import APT_LISTS_LOCKS, DPKG_LOCKS, RESULT_PREFIX
+import mirrors
+import restart_check
+import install_plan
+import peer_cache
 
 inhibitor_fd = None  # Global file descriptor for shutdown inhibit
+shutdown_reply = None  # D-Bus reply to the shutdown watcher (on-demand mode)
+shutdown_flow = None  # Running ShutdownFlow, at most one per process
 
 
 # Connect D-Bus with the GLib Mainloop
@@ -24,10 +32,53 @@ dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 # Path to the configuration file in the user's home directory
 CONFIG_PATH = Path.home() / '.config/mintupdater/config.json'
 
+# Path to the file with the latest measured values (lock wait time, ...)
+METRICS_PATH = Path.home() / '.config/mintupdater/metrics.json'
+
+# Lock-aware step runner, started as root via pkexec
+APT_LOCKS_SCRIPT = Path(__file__).resolve().parent / 'apt_locks.py'
+
+# System-wide default deployment mode, written by the administrator (see postinst)
+SYSTEM_MODE_PATH = Path('/etc/mintupdater/mode')
+
+# Deployment modes:
+# - resident: this script runs for the whole session (started via autostart)
+# - on-demand: a systemd user timer runs '--check-once', shutdown_watcher.py stays
+#   resident, and this script is started via D-Bus activation when a prompt is needed
+MODE_RESIDENT = "resident"
+MODE_ON_DEMAND = "on-demand"
+
+# D-Bus name of the UI process (see usr/share/dbus-1/services)
+BUS_NAME = "org.mintupdater.Updater"
+OBJECT_PATH = "/org/mintupdater/Updater"
+INTERFACE = "org.mintupdater.Updater"
+
+# An activated UI process exits after being idle for this many seconds
+IDLE_EXIT_SECONDS = 60
+
+# Minimum logind InhibitDelayMaxSec needed to install updates at shutdown
+MIN_INHIBIT_DELAY_SECONDS = 36000
+
+# Default timeouts (seconds) of the shutdown flow states; None for 'installing'
+# means: up to one minute before logind's InhibitDelayMaxSec runs out
+SHUTDOWN_TIMEOUTS = {
+    "probing": 300,
+    "prompting": 120,
+    "installing": None,
+    "releasing": 30
+}
+
 # Default configuration if no config is found
 DEFAULT_CONFIG = {
     "interval_hours": 4,           # Interval for automatic update checks in hours
-    "install_on_shutdown": False   # Flag to decide whether updates should be installed automatically at shutdown
+    "install_on_shutdown": False,  # Flag to decide whether updates should be installed automatically at shutdown
+    "lock_wait_minutes": 30,       # How long install steps may wait for apt/dpkg locks held by other programs
+    "mirror_candidates": [],       # Mirrors of the same archive to rank; sources using one of them get the fastest
+    "mirror_cache_hours": 24,      # How long a mirror ranking is reused
+    "install_live_updates": False, # Install updates that no running program uses right away, the rest at shutdown
+    "peer_cache": False,           # Share downloaded packages with other machines on the LAN and fetch from them first
+    "peer_cache_port": 47801,      # HTTP port of the peer cache
+    "peer_cache_peers": []         # Peers to ask in addition to the discovered ones, e.g. "http://10.0.0.5:47801"
 }
 
 def load_config():
@@ -51,6 +102,46 @@ def save_config(config):
     with open(CONFIG_PATH, 'w') as f:
         json.dump(config, f)
 
+def get_mode(config):
+    """
+    Returns the deployment mode: the user's choice, else the system default, else resident.
+    """
+    mode = config.get("mode")
+    if mode is None:
+        try:
+            mode = SYSTEM_MODE_PATH.read_text().strip()
+        except OSError:
+            mode = MODE_RESIDENT
+    return mode if mode in (MODE_RESIDENT, MODE_ON_DEMAND) else MODE_RESIDENT
+
+def record_metric(name, value):
+    """
+    Stores the latest value of a metric together with a timestamp in the metrics file.
+    """
+    metrics = {}
+    try:
+        with open(METRICS_PATH, 'r') as f:
+            metrics = json.load(f)
+    except (OSError, ValueError):
+        pass
+    metrics[name] = {"value": value, "time": datetime.now().isoformat(timespec='seconds')}
+    os.makedirs(METRICS_PATH.parent, exist_ok=True)
+    with open(METRICS_PATH, 'w') as f:
+        json.dump(metrics, f)
+
+def ranked_mirrors(config, force=False):
+    """
+    Returns the configured candidate mirrors ordered fastest first.
+    The ranking is measured again when it is older than 'mirror_cache_hours'.
+    """
+    candidates = config.get('mirror_candidates', [])
+    max_age = config.get('mirror_cache_hours', 24) * 3600
+    try:
+        return mirrors.get_ranked_mirrors(candidates, max_age, force=force)
+    except Exception as e:
+        print("Mirror ranking failed:", e)
+        return list(candidates)
+
 def check_updates():
     """
     Checks if system updates are available using mintupdate-cli.
@@ -152,26 +243,181 @@ def get_inhibit_delay():
 def install_updates():
     """
     Installs updates with elevated privileges.
-    Runs 'apt update', 'apt upgrade -y', and 'flatpak update -y'.
-    Executes 'mintupdate-cli upgrade -y' for Mint Updates.
+    Runs 'apt update', 'apt upgrade -y', 'flatpak update -y', 'mintupdate-cli upgrade -y'
+    and 'apt autoremove -y' through the lock-aware runner (apt_locks.py) with a single pkexec call.
+    If Synaptic or mintupdate holds the apt/dpkg locks, each step waits behind it
+    instead of failing; a step still locked at the deadline is skipped and the others run.
     """
-    subprocess.run([
-    'pkexec', 'bash', '-c',
-    "apt update && apt upgrade -y && flatpak update -y && mintupdate-cli upgrade -y && apt autoremove -y"
-    ])    
+    steps = [
+        {"cmd": ['apt', 'update'], "locks": APT_LISTS_LOCKS},
+        {"cmd": ['apt', 'upgrade', '-y'], "locks": DPKG_LOCKS, "prefetch": True},
+        {"cmd": ['flatpak', 'update', '-y'], "locks": []},
+        {"cmd": ['mintupdate-cli', 'upgrade', '-y'], "locks": DPKG_LOCKS},
+        {"cmd": ['apt', 'autoremove', '-y'], "locks": DPKG_LOCKS},
+    ]
+    run_privileged_steps(steps)
     subprocess.run([
     'cinnamon-spice-updater', '--update-all'
     ])
 
+def install_live_updates(confirm=None):
+    """
+    Installs only the updates that do not touch files used by running programs
+    (see install_plan.py). Updates for running applications are left for the shutdown.
+    apt and the system Flatpaks are planned again by the root runner, which sees the
+    processes of all users; the plan made here decides whether that is needed and
+    covers the user's own Flatpaks.
+    confirm is called before the root runner is started; if it returns False the
+    updates that need it are left for the shutdown instead of asking for a password.
+    Returns the install plan.
+    """
+    plan = install_plan.plan_install()
+    user_live = [ref for ref in plan['flatpak_live'] if ref[0] == "user"]
+    user_deferred = [ref for ref in plan['flatpak_deferred'] if ref[0] == "user"]
+
+    # Whatever the root runner does not install waits for the shutdown
+    result = {
+        "apt_live": [],
+        "apt_deferred": plan['apt_live'] + plan['apt_deferred'],
+        "flatpak_live": [],
+        "flatpak_deferred": [ref for ref in plan['flatpak_live'] + plan['flatpak_deferred']
+                             if ref[0] == "system"],
+    }
+    needs_root = plan['apt_live'] or len(user_live) < len(plan['flatpak_live'])
+    if needs_root and (confirm is None or confirm()):
+        steps = [{"plan": "live"}]
+        if plan['apt_live']:
+            steps.insert(0, {"cmd": ['apt-get', 'update'], "locks": APT_LISTS_LOCKS})
+        summary = run_privileged_steps(steps)
+        if summary is not None and "plan" in summary:
+            result = summary["plan"]
+    if user_live and subprocess.run(['flatpak', 'update', '--user', '-y', '--noninteractive',
+                                     *[ref for _, ref in user_live]]).returncode != 0:
+        # Not installed, so offer them again later
+        user_deferred = user_live + user_deferred
+        user_live = []
+    result['flatpak_live'] += user_live
+    result['flatpak_deferred'] += user_deferred
+    print(f"Live-safe: {len(result['apt_live'])} packages, {len(result['flatpak_live'])} Flatpaks; "
+          f"deferred: {len(result['apt_deferred'])} packages, {len(result['flatpak_deferred'])} Flatpaks.")
+    return result
+
+def run_privileged_steps(steps):
+    """
+    Runs the steps as root through the lock-aware runner (apt_locks.py) with a single pkexec call.
+    Returns the runner's result, or None if it did not run (e.g. authentication was cancelled).
+    """
+    config = load_config()
+    timeout = config.get('lock_wait_minutes', 30) * 60
+    options = {}
+    ranked = ranked_mirrors(config)
+    if len(ranked) > 1:
+        print("Using mirror", ranked[0])
+        options["mirrors"] = {"replace": config['mirror_candidates'], "mirrors": ranked}
+    if config.get('peer_cache', False):
+        peers = list(config.get('peer_cache_peers', []))
+        peers += [p for p in peer_cache.discover_peers() if p not in peers]
+        print(f"Peer caches: {', '.join(peers) or 'none'}")
+        options["peers"] = peers
+    args = ['pkexec', sys.executable, str(APT_LOCKS_SCRIPT), str(timeout), json.dumps(steps)]
+    if options:
+        args.append(json.dumps(options))
+    result = subprocess.run(
+        args,
+        stdout=subprocess.PIPE,
+        text=True
+    )
+    summary = None
+    for line in result.stdout.splitlines():
+        if line.startswith(RESULT_PREFIX):
+            summary = json.loads(line[len(RESULT_PREFIX):])
+            print(f"Waited {summary['lock_wait_seconds']} s for apt/dpkg locks.")
+            record_metric("lock_wait_seconds", summary['lock_wait_seconds'])
+            if options.get("peers"):
+                print(f"Got {summary['from_peers']['files']} packages from peers.")
+                record_metric("peer_cache_bytes", summary['from_peers']['bytes'])
+            for step in summary['steps']:
+                if step['status'] != 'ok':
+                    print(f"Update step '{' '.join(step['cmd'])}' {step['status']}.")
+    return summary
+
+def start_peer_cache(config):
+    """
+    Serves the local apt archive cache to other machines if 'peer_cache' is enabled.
+    """
+    if not config.get('peer_cache', False):
+        return None
+    try:
+        return peer_cache.PeerCache(port=config.get('peer_cache_port', peer_cache.DEFAULT_PORT)).start()
+    except OSError as e:
+        print("Could not start the peer cache:", e)
+        return None
+
+def updates_available():
+    """
+    Returns True if apt, Flatpak or Cinnamon Spice updates are available.
+    """
+    return check_updates() or check_flatpak_updates() or check_spices()
+
+def prompt_wanted(config):
+    """
+    Returns True if the user wants to be asked during the session when updates are found.
+    """
+    always_show = config.get('always_show_prompt', False)
+    install_on_shutdown = config.get('install_on_shutdown', False)
+    return not install_on_shutdown or always_show
+
+def release_shutdown():
+    """
+    Lets the shutdown continue: closes the inhibitor (resident mode)
+    or answers the shutdown watcher (on-demand mode), then leaves the main loop.
+    """
+    global inhibitor_fd, shutdown_reply
+    if inhibitor_fd is not None:
+        inhibitor_fd.close()
+        inhibitor_fd = None
+    if shutdown_reply is not None:
+        shutdown_reply()
+        shutdown_reply = None
+        dbus.SessionBus().flush()
+    Gtk.main_quit()
+
 class UpdateChecker:
     """
     A class that periodically checks for updates and prompts the user when updates are available.
     Uses GTK dialogs for user interaction.
+    With periodic=False (D-Bus activated) no checks are scheduled and the
+    process quits once it has been idle for IDLE_EXIT_SECONDS.
     """
-    def __init__(self):
+    def __init__(self, periodic=True):
         self.config = load_config()
         self.running = True
-        self.schedule_initial_check()
+        self.periodic = periodic
+        self.busy = 0  # Number of open prompts and running installs
+        self.prompt_open = False
+        if periodic:
+            self.schedule_initial_check()
+        else:
+            self.schedule_idle_exit()
+
+    def begin_work(self):
+        self.busy += 1
+
+    def end_work(self):
+        self.busy -= 1
+        self.schedule_idle_exit()
+
+    def schedule_idle_exit(self):
+        # Quits an activated process if nothing happens until the timeout
+        if self.periodic or self.busy:
+            return
+
+        def quit_if_idle():
+            if not self.busy and self.running:
+                print("Idle, exiting.")
+                Gtk.main_quit()
+            return False
+        GLib.timeout_add_seconds(IDLE_EXIT_SECONDS, quit_if_idle)
 
     def schedule_initial_check(self):
         # Starts the first update check with a 2-minute delay in a background thread
@@ -192,14 +438,70 @@ class UpdateChecker:
     def check_and_prompt(self):
         # Checks for updates and shows a dialog if available (in the GTK Main Thread)
         config = load_config()
-        always_show = config.get('always_show_prompt', False)
-        install_on_shutdown = config.get('install_on_shutdown', False)
-        if not install_on_shutdown or always_show:
-            if check_updates() or check_flatpak_updates() or check_spices():
-                GLib.idle_add(self.show_prompt)
+        # Refresh an expired mirror ranking now, so installing does not have to wait for it
+        ranked_mirrors(config)
+        if prompt_wanted(config) or config.get('install_live_updates', False):
+            if updates_available():
+                self.handle_updates_found(config)
+
+    def handle_updates_found(self, config):
+        # Installs the live-safe updates if enabled, then asks about the rest (worker thread)
+        if config.get('install_live_updates', False):
+            GLib.idle_add(self.begin_work)
+            try:
+                plan = install_live_updates(confirm=self.confirm_live_install)
+            except Exception as e:
+                print("Installing live-safe updates failed:", e)
+                plan = None
+            GLib.idle_add(self.end_work)
+            if plan is not None and not (plan['apt_deferred'] or plan['flatpak_deferred']) \
+                    and not check_spices():
+                print("All updates were installed live.")
+                return
+        if prompt_wanted(config):
+            GLib.idle_add(self.show_prompt)
+
+    def confirm_live_install(self):
+        # Asks before pkexec shows its password dialog out of nowhere (worker thread)
+        answer = {}
+        answered = threading.Event()
+
+        def ask():
+            dialog = Gtk.MessageDialog(
+                parent=None,
+                flags=0,
+                message_type=Gtk.MessageType.QUESTION,
+                buttons=Gtk.ButtonsType.NONE,
+                text="Install Updates Now?"
+            )
+            dialog.format_secondary_text(
+                "Some updates can be installed now without affecting running programs.\n"
+                "This needs your administrator password. The other updates stay for later."
+            )
+            dialog.add_button("Not Now", Gtk.ResponseType.CANCEL)
+            dialog.add_button("Install", Gtk.ResponseType.OK)
+
+            def on_response(dlg, response):
+                answer["install"] = response == Gtk.ResponseType.OK
+                dlg.destroy()
+                answered.set()
+
+            dialog.connect("response", on_response)
+            dialog.show_all()
+            return False
+
+        GLib.idle_add(ask)
+        answered.wait()
+        if not answer["install"]:
+            print("Live-safe install postponed by the user.")
+        return answer["install"]
 
     def show_prompt(self):
         # Shows a dialog asking the user whether to install updates
+        if self.prompt_open:
+            return False
+        self.prompt_open = True
+        self.begin_work()
         dialog = Gtk.MessageDialog(
             parent=None,
             flags=0,
@@ -225,134 +527,326 @@ class UpdateChecker:
                 wait_dialog.set_title("System Update")
                 wait_dialog.show_all()
 
+                self.begin_work()
+
                 def do_updates():
                     install_updates()
+                    try:
+                        stale = restart_check.stale_applications()
+                    except Exception as e:
+                        print("Restart check failed:", e)
+                        stale = []
                     GLib.idle_add(wait_dialog.destroy)
+                    if stale:
+                        self.begin_work()
+                        GLib.idle_add(self.show_restart_prompt, stale)
+                    GLib.idle_add(self.end_work)
                 threading.Thread(target=do_updates, daemon=True).start()
             elif response == Gtk.ResponseType.NO:
-                if not ensure_inhibit_delay():
-                   print("Delay not sufficient. The script will exit.")
-                   inhibitor_fd.close()
-                   return  # or sys.exit(1)
-                # Set the flag for installing updates on shutdown, without deleting it
-                config = load_config()
-                config['install_on_shutdown'] = True
-                save_config(config)
+                if ensure_inhibit_delay():
+                    # Set the flag for installing updates on shutdown, without deleting it
+                    config = load_config()
+                    config['install_on_shutdown'] = True
+                    save_config(config)
+                else:
+                    # Keep the inhibitor; the shutdown flow reports the short delay itself
+                    print("Delay not sufficient, not enabling install on shutdown.")
             dlg.destroy()
+            self.prompt_open = False
+            self.end_work()
 
         dialog.connect("response", on_response)
         dialog.show_all()
+        return False
 
-def handle_prepare_for_shutdown(starting):
+    def show_restart_prompt(self, stale):
+        # Lists the applications and services that still run replaced files
+        apps = [g["name"] for g in stale if g["kind"] == "app"]
+        others = [g["name"] for g in stale if g["kind"] != "app"]
+        dialog = Gtk.MessageDialog(
+            parent=None,
+            flags=0,
+            message_type=Gtk.MessageType.INFO,
+            buttons=Gtk.ButtonsType.OK,
+            text="Updates installed"
+        )
+        lines = []
+        if apps:
+            lines.append("Please restart these applications to use the updated versions:")
+            lines += [f"  • {name}" for name in apps]
+        if others:
+            lines.append("These services and programs still use old files until restarted or the next reboot:")
+            lines += [f"  • {name}" for name in others]
+        dialog.format_secondary_text("\n".join(lines))
+
+        def on_response(dlg, response):
+            dlg.destroy()
+            self.end_work()
+
+        dialog.connect("response", on_response)
+        dialog.show_all()
+        return False
+
+class UpdaterService(dbus.service.Object):
     """
-    Triggered on shutdown signal.
-    Installs updates before shutdown if configured.
-    Delays the shutdown until updates are installed.
+    Session bus interface of the UI process, used in on-demand mode.
+    The process is started by D-Bus activation on the first method call.
     """
-    if not starting:
-        return
-    
-    config = load_config()
+    def __init__(self, app):
+        bus_name = dbus.service.BusName(BUS_NAME, bus=dbus.SessionBus())
+        dbus.service.Object.__init__(self, bus_name, OBJECT_PATH)
+        self.app = app
+
+    @dbus.service.method(INTERFACE, in_signature='', out_signature='')
+    def ShowUpdatePrompt(self):
+        # Called by '--check-once' when updates were found
+        GLib.idle_add(self.app.show_prompt)
+
+    @dbus.service.method(INTERFACE, in_signature='', out_signature='')
+    def HandleUpdatesFound(self):
+        # Called by '--check-once' when live-safe installs are enabled
+        self.app.begin_work()
+
+        def work():
+            self.app.handle_updates_found(load_config())
+            GLib.idle_add(self.app.end_work)
+        threading.Thread(target=work, daemon=True).start()
+
+    @dbus.service.method(INTERFACE, in_signature='', out_signature='',
+                         async_callbacks=('reply', 'error'))
+    def HandleShutdown(self, reply, error):
+        # Called by shutdown_watcher.py; the reply lets the shutdown continue
+        global shutdown_reply
+        shutdown_reply = reply
+        self.app.begin_work()
+        handle_prepare_for_shutdown(True)
+
+class ShutdownFlow:
+    """
+    Non-blocking state machine for the shutdown path:
+
+        probing -> prompting -> installing -> releasing
+           |            |                        ^
+           +------------+------------------------+
+
+    Every state has its own timeout (config 'shutdown_timeouts', in seconds),
+    so the shutdown is delayed at most by the sum of the timeouts.
+    If the user does not answer the prompt, 'shutdown_default_action' is taken
+    ("shutdown" = without updates, "update" = install first).
+    All transitions run in the GTK main thread; the inhibitor is released exactly once.
+    """
+    PROBING = "probing"
+    PROMPTING = "prompting"
+    INSTALLING = "installing"
+    RELEASING = "releasing"
+
+    def __init__(self, config):
+        self.config = config
+        self.timeouts = dict(SHUTDOWN_TIMEOUTS)
+        self.timeouts.update(config.get("shutdown_timeouts", {}))
+        self.default_action = config.get("shutdown_default_action", "shutdown")
+        self.state = None
+        self.dialog = None
+        self.timer_id = None
+        self.released = False
+        # logind's delay runs from PrepareForShutdown, not from the current state
+        self.started = time.monotonic()
+
+    def start(self):
+        self.enter(self.PROBING)
+
+    def enter(self, state, message=None):
+        # Leaves the current state (dialog, timer) and enters the new one
+        if self.released:
+            return
+        print(f"[DEBUG] Shutdown flow: {self.state} -> {state}")
+        self.close_dialog()
+        if self.timer_id is not None:
+            GLib.source_remove(self.timer_id)
+            self.timer_id = None
+        self.state = state
+
+        timeout = self.timeouts.get(state)
+        if state == self.INSTALLING:
+            # Leave a minute of the logind delay for the rest of the shutdown
+            elapsed = time.monotonic() - self.started
+            remaining = max(1, get_inhibit_delay() - 60 - elapsed)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        if timeout is not None:
+            self.timer_id = GLib.timeout_add_seconds(int(timeout), self.on_timeout, state)
+
+        if state == self.PROBING:
+            self.start_probing()
+        elif state == self.PROMPTING:
+            self.show_prompt()
+        elif state == self.INSTALLING:
+            self.start_installing()
+        elif state == self.RELEASING:
+            self.show_notice(message)
+
+    def on_timeout(self, state):
+        self.timer_id = None
+        if state != self.state or self.released:
+            return False
+        print(f"[DEBUG] Shutdown flow: timeout in state {state}")
+        if state == self.PROMPTING:
+            self.on_decision(self.default_action == "update")
+        else:
+            # Probing or installing took too long, or nobody read the notice
+            self.release()
+        return False
 
-    def shutdown_flow():
-        print("[DEBUG] handle_prepare_for_shutdown called")
+    def in_state(self, state, callback, *args):
+        # Runs a callback from a worker thread in the main thread, unless the state changed meanwhile
+        def run():
+            if self.state == state and not self.released:
+                callback(*args)
+            return False
+        GLib.idle_add(run)
+
+    def start_probing(self):
         # Show a 'please wait' dialog while searching for updates
-        wait_dialog = Gtk.MessageDialog(
-            parent=None,
-            flags=Gtk.DialogFlags.MODAL,
-            message_type=Gtk.MessageType.INFO,
-            buttons=Gtk.ButtonsType.NONE,
-            text="Please wait. Searching for Updates..."
-        )
-        wait_dialog.set_title("System Update")
-        wait_dialog.show_all()
+        self.dialog = self.wait_dialog("Please wait. Searching for Updates...")
 
         def do_update_checks():
             try:
-                updates_available = check_updates() or check_flatpak_updates() or check_spices()
+                found = updates_available()
             except Exception as e:
                 print("[ERROR] Exception during update checks:", e)
-                updates_available = False
-            def after_checks():
-                wait_dialog.destroy()
-                if config.get("install_on_shutdown", False):
-                    print("Auto-installing updates on shutdown...")
-                    if updates_available and suf_inhibit_delay():
-                        print("[DEBUG] Updates found, installing...")
-                        show_wait_dialog_and_install()
-                    else:
-                        print("No updates to install.")
-                        inhibitor_fd.close()
-                        Gtk.main_quit()
-                    return
-
-                # If no updates are available, proceed with normal shutdown
-                if not updates_available:
-                    print("[DEBUG] No updates available, proceeding with shutdown.")
-                    inhibitor_fd.close()
-                    Gtk.main_quit()
-                    return
-
-                # Updates available and no auto-install flag, ask the user
-                response, main_window = show_shutdown_prompt()
-                if response == Gtk.ResponseType.OK and suf_inhibit_delay():
-                    print("[DEBUG] User chose to update and shutdown.")
-                    show_wait_dialog_and_install(main_window)
-                    return
-                elif response == Gtk.ResponseType.NO:
-                    print("[DEBUG] User chose to shutdown without updates.")
-                    inhibitor_fd.close()
-                    Gtk.main_quit()
-                else:
-                    print("Shutdown canceled by user.")
-                    inhibitor_fd.close()
-                    Gtk.main_quit()
-            GLib.idle_add(after_checks)
+                found = False
+            self.in_state(self.PROBING, self.after_probing, found)
         threading.Thread(target=do_update_checks, daemon=True).start()
 
-    def show_wait_dialog_and_install(main_window=None):
-        def _show_dialog():
-            wait_dialog = Gtk.MessageDialog(
-                transient_for=main_window,
-                flags=Gtk.DialogFlags.MODAL,
-                message_type=Gtk.MessageType.INFO,
-                buttons=Gtk.ButtonsType.NONE,
-                text="Please wait, updates are being installed.\nDo not power off the computer."
+    def after_probing(self, found):
+        if not found:
+            print("[DEBUG] No updates available, proceeding with shutdown.")
+            self.release()
+        elif self.config.get("install_on_shutdown", False):
+            print("Auto-installing updates on shutdown...")
+            self.on_decision(True)
+        else:
+            # Updates available and no auto-install flag, ask the user
+            self.enter(self.PROMPTING)
+
+    def show_prompt(self):
+        # Asks the user if they want to install updates before shutdown
+        dialog = Gtk.MessageDialog(
+           parent=None,
+           flags=0,
+           message_type=Gtk.MessageType.QUESTION,
+           buttons=Gtk.ButtonsType.NONE,
+           text="Updates Available at Shutdown"
+        )
+        default = "install updates" if self.default_action == "update" else "shut down without updates"
+        dialog.format_secondary_text(
+            "Do you want to install updates before shutdown?\n"
+            f"Without an answer the computer will {default} in {self.timeouts[self.PROMPTING]} seconds."
+        )
+        dialog.add_button("Update and Shutdown", Gtk.ResponseType.OK)
+        dialog.add_button("Shutdown without Updates", Gtk.ResponseType.NO)
+        dialog.add_button("Cancel", Gtk.ResponseType.CANCEL)
+
+        def on_response(dlg, response):
+            if self.state != self.PROMPTING:
+                return
+            if response == Gtk.ResponseType.OK:
+                print("[DEBUG] User chose to update and shutdown.")
+                self.on_decision(True)
+            elif response == Gtk.ResponseType.NO:
+                print("[DEBUG] User chose to shutdown without updates.")
+                self.on_decision(False)
+            else:
+                print("Shutdown canceled by user.")
+                self.release()
+
+        dialog.connect("response", on_response)
+        dialog.show_all()
+        self.dialog = dialog
+
+    def on_decision(self, install):
+        if not install:
+            self.release()
+            return
+        delay_seconds = get_inhibit_delay()
+        if delay_seconds < MIN_INHIBIT_DELAY_SECONDS:
+            self.enter(
+                self.RELEASING,
+                f"Your system currently allows only a shutdown delay of {delay_seconds/60} minutes.\n"
+                "Updates cannot be installed at shutdown.\n Please adjust in the Control Panel."
             )
-            wait_dialog.set_title("System Update")
-            wait_dialog.show_all()
-
-            def do_updates():
-                print("[DEBUG] Installing updates in background thread...")
-                install_updates()
-                GLib.idle_add(wait_dialog.destroy)
-                GLib.idle_add(lambda: inhibitor_fd.close())
-                GLib.idle_add(Gtk.main_quit)
-            threading.Thread(target=do_updates, daemon=True).start()
-        GLib.idle_add(_show_dialog)
-
-    # Always run shutdown_flow in the main thread
-    GLib.idle_add(shutdown_flow)
-
-def show_shutdown_prompt():
-    """
-    Displays a dialog when the system is shutting down, asking the user if they want to install updates before shutdown.
-    """
-    main_window = Gtk.Window()
-    dialog = Gtk.MessageDialog(
-       parent=main_window,
-       flags=0,
-       message_type=Gtk.MessageType.QUESTION,
-       buttons=Gtk.ButtonsType.NONE,
-       text="Updates Available at Shutdown"
-    )
-    dialog.format_secondary_text("Do you want to install updates before shutdown?")
-    dialog.add_button("Update and Shutdown", Gtk.ResponseType.OK)
-    dialog.add_button("Shutdown without Updates", Gtk.ResponseType.NO)
-    dialog.add_button("Cancel", Gtk.ResponseType.CANCEL)
-    response = dialog.run()
-    dialog.destroy()
-    return response, main_window
+            return
+        self.enter(self.INSTALLING)
+
+    def start_installing(self):
+        self.dialog = self.wait_dialog(
+            "Please wait, updates are being installed.\nDo not power off the computer."
+        )
+
+        def do_updates():
+            print("[DEBUG] Installing updates in background thread...")
+            install_updates()
+            self.in_state(self.INSTALLING, self.release)
+        threading.Thread(target=do_updates, daemon=True).start()
+
+    def show_notice(self, message):
+        # Shows why the shutdown continues without updates; closes on OK or timeout
+        if message is None:
+            self.release()
+            return
+        dialog = Gtk.MessageDialog(
+            parent=None,
+            flags=0,
+            message_type=Gtk.MessageType.WARNING,
+            buttons=Gtk.ButtonsType.OK,
+            text=message
+        )
+        dialog.connect("response", lambda dlg, response: self.release())
+        dialog.show_all()
+        self.dialog = dialog
+
+    def wait_dialog(self, text):
+        dialog = Gtk.MessageDialog(
+            parent=None,
+            flags=Gtk.DialogFlags.MODAL,
+            message_type=Gtk.MessageType.INFO,
+            buttons=Gtk.ButtonsType.NONE,
+            text=text
+        )
+        dialog.set_title("System Update")
+        dialog.show_all()
+        return dialog
+
+    def close_dialog(self):
+        if self.dialog is not None:
+            dialog, self.dialog = self.dialog, None
+            dialog.destroy()
+
+    def release(self):
+        # The only place where the shutdown flow lets the shutdown continue
+        if self.released:
+            return
+        self.released = True
+        self.state = self.RELEASING
+        if self.timer_id is not None:
+            GLib.source_remove(self.timer_id)
+            self.timer_id = None
+        self.close_dialog()
+        release_shutdown()
+
+def handle_prepare_for_shutdown(starting):
+    """
+    Triggered on shutdown signal.
+    Starts the shutdown state machine, which installs updates before shutdown
+    if configured or wanted, and delays the shutdown at most by its timeouts.
+    """
+    global shutdown_flow
+    if not starting or shutdown_flow is not None:
+        return
+    print("[DEBUG] handle_prepare_for_shutdown called")
+    shutdown_flow = ShutdownFlow(load_config())
+
+    # Always run the state machine in the main thread
+    GLib.idle_add(shutdown_flow.start)
 
 def inhibit_shutdown():
     """
@@ -372,7 +866,7 @@ def inhibit_shutdown():
     fd = os.fdopen(fd_int, 'w')
     return fd  # Must be kept open to prevent shutdown from proceeding
 
-def ensure_inhibit_delay(min_required_seconds=36000):
+def ensure_inhibit_delay(min_required_seconds=MIN_INHIBIT_DELAY_SECONDS):
     """
     Ensures that the 'InhibitDelayMaxSec' property is at least the specified value.
     If the current delay is too short, shows a dialog to ask the user to increase the delay.
@@ -490,66 +984,57 @@ def ensure_inhibit_delay(min_required_seconds=36000):
         err.destroy()
         return False
 
-def suf_inhibit_delay(min_required_seconds=36000):
+def check_once():
     """
-    Ensures that the 'InhibitDelayMaxSec' property is at least the specified value.
-    If the current delay is too short, shows a dialog to ask the user to increase the delay.
-    Returns True if the requirement is met, False otherwise.
+    One-shot check used by the systemd user timer in on-demand mode.
+    If updates are found and a prompt is wanted (or live-safe installs are enabled), the UI process
+    is started via D-Bus activation to handle them; this process exits right away.
     """
+    config = load_config()
+    if get_mode(config) != MODE_ON_DEMAND:
+        # Globally enabled timer, but this user runs the resident process
+        return 0
+    ranked_mirrors(config)
+    live = config.get('install_live_updates', False)
+    if not (prompt_wanted(config) or live) or not updates_available():
+        return 0
     try:
-        # Read the current delay via busctl
-        result = subprocess.run(
-            ['busctl', 'get-property', 'org.freedesktop.login1', '/org/freedesktop/login1',
-             'org.freedesktop.login1.Manager', 'InhibitDelayMaxUSec'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=True
-        )
-        _, microseconds_str = result.stdout.strip().split()
-        delay_seconds = int(int(microseconds_str) / 1_000_000)
-
-        # Check if the delay is sufficient
-        if delay_seconds >= min_required_seconds:
-            return True
-
-        # If the delay is too short, notify the user
-        dialog = Gtk.MessageDialog(
-            parent=None,
-            flags=0,
-            message_type=Gtk.MessageType.WARNING,
-            buttons=Gtk.ButtonsType.NONE,
-            text=f"Your system currently allows only a shutdown delay of {delay_seconds/60} minutes.\n"
-                 "Updates cannot be installed at shutdown.\n Please adjust in the Control Panel."
-        )
-        dialog.add_button("OK", Gtk.ResponseType.OK)
-        response = dialog.run()
-        dialog.destroy()
-        return False
-
-    except Exception as e:
-        err = Gtk.MessageDialog(
-            parent=None,
-            flags=0,
-            message_type=Gtk.MessageType.ERROR,
-            buttons=Gtk.ButtonsType.OK,
-            text="Error while increasing the delay."
-        )
-        err.format_secondary_text(str(e))
-        err.run()
-        err.destroy()
-        return False
+        proxy = dbus.SessionBus().get_object(BUS_NAME, OBJECT_PATH)
+        if live:
+            # Installing needs pkexec with the session's polkit agent, so the UI process does it
+            dbus.Interface(proxy, INTERFACE).HandleUpdatesFound()
+        else:
+            dbus.Interface(proxy, INTERFACE).ShowUpdatePrompt()
+    except dbus.DBusException as e:
+        print("Could not start the update prompt:", e)
+        return 1
+    return 0
 
 def main():
     """
     Main function:
-    - Sets the shutdown inhibit to delay shutdown for updates
-    - Starts the GTK event loop in the background
-    - Starts the UpdateChecker to periodically check for updates
-    - Registers a D-Bus signal receiver to handle shutdown events
-    - Waits indefinitely (or until KeyboardInterrupt)
+    - '--check-once': runs a single update check (systemd user timer, on-demand mode)
+    - '--activated': started via D-Bus activation, serves prompts and the shutdown flow
+    - without arguments (resident mode):
+      - Sets the shutdown inhibit to delay shutdown for updates
+      - Starts the UpdateChecker to periodically check for updates
+      - Registers a D-Bus signal receiver to handle shutdown events
+      - Runs the GTK main loop indefinitely (or until KeyboardInterrupt)
     """
     global inhibitor_fd
+    if '--check-once' in sys.argv:
+        sys.exit(check_once())
+
+    if '--activated' in sys.argv:
+        app = UpdateChecker(periodic=False)
+        service = UpdaterService(app)
+        Gtk.main()
+        return
+
+    if get_mode(load_config()) == MODE_ON_DEMAND:
+        print("On-demand mode is active, the resident checker is not needed.")
+        return
+
     try:
         inhibitor_fd = inhibit_shutdown()
         print("Shutdown inhibited.")
@@ -559,6 +1044,7 @@ def main():
 
     # Initialize the update checker
     app = UpdateChecker()
+    cache = start_peer_cache(load_config())
 
     # Activate D-Bus signal receiver to handle shutdown signals
     bus = dbus.SystemBus()
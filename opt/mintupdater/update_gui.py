@@ -6,7 +6,7 @@ from gi.repository import Gtk
 import json
 import os
 from pathlib import Path
-from update_checker import ensure_inhibit_delay
+from update_checker import ensure_inhibit_delay, get_mode, MODE_RESIDENT, MODE_ON_DEMAND
 import subprocess
 
 # Path to user configuration file
@@ -17,6 +17,11 @@ AUTOSTART_DIR = Path.home() / ".config" / "autostart"
 AUTOSTART_FILE = AUTOSTART_DIR / "mintupdater-shutdown.desktop"
 SYSTEM_AUTOSTART = "/etc/xdg/autostart/mintupdater-shutdown.desktop"
 
+# systemd user units used in on-demand mode
+WATCHER_UNIT = "mintupdater-watcher.service"
+TIMER_UNIT = "mintupdater-check.timer"
+TIMER_DROPIN = Path.home() / ".config" / "systemd" / "user" / (TIMER_UNIT + ".d") / "interval.conf"
+
 # Load user configuration or return empty dict if missing
 def load_config():
     if CONFIG_PATH.exists():
@@ -30,6 +35,67 @@ def save_config(cfg):
     with open(CONFIG_PATH, 'w') as f:
         json.dump(cfg, f)
 
+# Run systemctl for the user manager and return whether it succeeded
+def systemctl_user(*args):
+    result = subprocess.run(
+        ["systemctl", "--user", *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL
+    )
+    return result.returncode == 0
+
+# Write the per-user autostart override with the given Hidden flag
+def write_autostart_override(hidden):
+    AUTOSTART_DIR.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(SYSTEM_AUTOSTART, 'r') as src:
+            lines = src.readlines()
+    except FileNotFoundError:
+        lines = [
+            "[Desktop Entry]\n",
+            "Type=Application\n",
+            "Name=UpdateChecker\n",
+            "Exec=/opt/mintupdater/update_checker.py\n",
+            "X-GNOME-Autostart-enabled=true\n",
+            "NoDisplay=false\n",
+        ]
+    with open(AUTOSTART_FILE, 'w') as dst:
+        for line in lines:
+            if line.strip().lower().startswith("hidden="):
+                continue
+            dst.write(line)
+        dst.write("Hidden=true\n" if hidden else "Hidden=false\n")
+
+# Turn the on-demand units on or off for this user. The units are enabled
+# globally by postinst, which a per-user 'disable' cannot undo, so opting
+# out masks them in the user's own configuration.
+def set_units_enabled(enabled):
+    if enabled:
+        systemctl_user("unmask", WATCHER_UNIT, TIMER_UNIT)
+        systemctl_user("enable", WATCHER_UNIT, TIMER_UNIT)
+    else:
+        systemctl_user("disable", WATCHER_UNIT, TIMER_UNIT)
+        systemctl_user("mask", WATCHER_UNIT, TIMER_UNIT)
+
+# Start the on-demand units for this session even if they are masked;
+# masking again afterwards keeps them from starting at the next login
+def start_units(enabled):
+    if not enabled:
+        systemctl_user("unmask", WATCHER_UNIT, TIMER_UNIT)
+    systemctl_user("start", WATCHER_UNIT, TIMER_UNIT)
+    if not enabled:
+        systemctl_user("mask", WATCHER_UNIT, TIMER_UNIT)
+
+# Set the check interval of the systemd timer via a drop-in file
+def write_timer_interval(hours):
+    TIMER_DROPIN.parent.mkdir(parents=True, exist_ok=True)
+    with open(TIMER_DROPIN, 'w') as f:
+        f.write("[Timer]\nOnUnitActiveSec=\n")
+        f.write(f"OnUnitActiveSec={hours}h\n")
+    systemctl_user("daemon-reload")
+    if systemctl_user("is-active", "--quiet", TIMER_UNIT):
+        systemctl_user("restart", TIMER_UNIT)
+
 class ConfigWindow(Gtk.Window):
     # Called when the 'Install on Shutdown' toggle is changed
     def on_toggle_install_on_shutdown(self, widget):
@@ -42,6 +108,10 @@ class ConfigWindow(Gtk.Window):
     def on_toggle_show_prompt(self, widget):
         self.save_settings()
 
+    # Called when the 'Install Safe Updates Right Away' checkbox is changed
+    def on_toggle_live_updates(self, widget):
+        self.save_settings()
+
     # Update the label of the autostart toggle depending on its state
     def update_autostart_label(self):
         if self.toggle_autostart.get_active():
@@ -49,46 +119,44 @@ class ConfigWindow(Gtk.Window):
         else:
             self.toggle_autostart.set_label("Autostart (Disabled)")
 
-    # Toggle autostart by creating or removing the .desktop file
+    # Toggle autostart: .desktop override (resident) or systemd user units (on-demand)
     def on_toggle_autostart(self, widget):
-        if widget.get_active():
-            if AUTOSTART_FILE.exists():
+        if self.mode == MODE_ON_DEMAND:
+            set_units_enabled(widget.get_active())
+        elif widget.get_active():
+            # An explicit override is needed if the system default is on-demand (Hidden=true)
+            if self.is_hidden(SYSTEM_AUTOSTART):
+                write_autostart_override(hidden=False)
+            elif AUTOSTART_FILE.exists():
                 AUTOSTART_FILE.unlink()
         else:
-            AUTOSTART_DIR.mkdir(parents=True, exist_ok=True)
-            try:
-                with open(SYSTEM_AUTOSTART, 'r') as src:
-                    lines = src.readlines()
-            except FileNotFoundError:
-                lines = [
-                    "[Desktop Entry]\n",
-                    "Type=Application\n",
-                    "Name=UpdateChecker\n",
-                    "Exec=/opt/mintupdater/update_checker.py\n",
-                    "X-GNOME-Autostart-enabled=true\n",
-                    "NoDisplay=false\n",
-                ]
-            with open(AUTOSTART_FILE, 'w') as dst:
-                for line in lines:
-                    if line.strip().lower().startswith("hidden="):
-                        continue
-                    dst.write(line)
-                dst.write("Hidden=true\n")
+            write_autostart_override(hidden=True)
         self.update_autostart_label()
         self.update_install_on_shutdown_sensitivity()
 
-    # Check whether autostart is enabled by verifying the hidden flag
+    # Check whether a .desktop file has the hidden flag set
+    def is_hidden(self, path):
+        try:
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.strip().lower() == "hidden=true":
+                        return True
+        except FileNotFoundError:
+            pass
+        return False
+
+    # Check whether autostart is enabled by verifying the hidden flag (or the systemd units)
     def is_autostart_enabled(self):
+        if self.mode == MODE_ON_DEMAND:
+            return systemctl_user("is-enabled", "--quiet", WATCHER_UNIT)
         if not AUTOSTART_FILE.exists():
-            return True
-        with open(AUTOSTART_FILE, 'r') as f:
-            for line in f:
-                if line.strip().lower() == "hidden=true":
-                    return False
-        return True
-
-    # Check whether the update checker daemon is currently running
+            return not self.is_hidden(SYSTEM_AUTOSTART)
+        return not self.is_hidden(AUTOSTART_FILE)
+
+    # Check whether the update checker daemon (or the shutdown watcher) is currently running
     def is_daemon_running(self):
+        if self.mode == MODE_ON_DEMAND:
+            return systemctl_user("is-active", "--quiet", WATCHER_UNIT)
         result = subprocess.run(
             ["pgrep", "-f", "update_checker.py"],
             stdout=subprocess.DEVNULL,
@@ -105,7 +173,12 @@ class ConfigWindow(Gtk.Window):
 
     # Start or stop the background update checker daemon
     def on_toggle_daemon(self, widget):
-        if widget.get_active():
+        if self.mode == MODE_ON_DEMAND:
+            if widget.get_active():
+                start_units(self.toggle_autostart.get_active())
+            else:
+                systemctl_user("stop", WATCHER_UNIT, TIMER_UNIT)
+        elif widget.get_active():
             if not self.is_daemon_running():
                 subprocess.Popen(['./update_checker.py'])
         else:
@@ -113,6 +186,41 @@ class ConfigWindow(Gtk.Window):
         self.update_daemon_label()
         self.update_install_on_shutdown_sensitivity()
 
+    # Switch between the resident process and the on-demand systemd units,
+    # keeping the current autostart and running state
+    def on_mode_changed(self, widget):
+        new_mode = MODE_ON_DEMAND if widget.get_active() == 1 else MODE_RESIDENT
+        if new_mode == self.mode:
+            return
+        autostart = self.toggle_autostart.get_active()
+        running = self.toggle_daemon.get_active()
+
+        # Shut down the old mode
+        if self.mode == MODE_ON_DEMAND:
+            systemctl_user("stop", WATCHER_UNIT, TIMER_UNIT)
+        else:
+            subprocess.run(['pkill', '-f', 'update_checker.py'])
+            write_autostart_override(hidden=True)
+
+        # Only an explicit switch pins the mode; otherwise the system default applies
+        self.mode = new_mode
+        config = load_config()
+        config['mode'] = new_mode
+        save_config(config)
+        if new_mode == MODE_ON_DEMAND:
+            write_timer_interval(int(self.dropdown.get_active_text().split()[0]))
+
+        # Bring up the new mode
+        if new_mode == MODE_ON_DEMAND:
+            set_units_enabled(autostart)
+            if running:
+                start_units(autostart)
+        else:
+            set_units_enabled(False)
+            write_autostart_override(hidden=not autostart)
+            if running:
+                subprocess.Popen(['/opt/mintupdater/update_checker.py'])
+
     # Button action to enforce shutdown delay setting via polkit
     def on_set_inhibit_delay_clicked(self, button):
         if ensure_inhibit_delay():
@@ -125,6 +233,7 @@ class ConfigWindow(Gtk.Window):
         enabled = autostart_enabled or daemon_enabled
         self.toggle_install_on_shutdown.set_sensitive(enabled)
         self.check_show_prompt.set_sensitive(enabled)
+        self.check_live_updates.set_sensitive(enabled)
 
     def __init__(self):
         Gtk.Window.__init__(self, title="Mint Update Checker Settings")
@@ -136,6 +245,8 @@ class ConfigWindow(Gtk.Window):
         interval = config.get("interval_hours", 4)
         install_on_shutdown = config.get("install_on_shutdown", False)
         always_show_prompt = config.get("always_show_prompt", False)
+        install_live_updates = config.get("install_live_updates", False)
+        self.mode = get_mode(config)
 
         vbox = Gtk.Box(orientation=Gtk.Orientation.VERTICAL, spacing=10)
         self.add(vbox)
@@ -149,6 +260,15 @@ class ConfigWindow(Gtk.Window):
         vbox.pack_start(Gtk.Label(label="Check for updates every:"), False, False, 0)
         vbox.pack_start(self.dropdown, False, False, 0)
 
+        # Deployment mode dropdown
+        self.mode_dropdown = Gtk.ComboBoxText()
+        self.mode_dropdown.append_text("Always running")
+        self.mode_dropdown.append_text("On demand (systemd timer)")
+        self.mode_dropdown.set_active(1 if self.mode == MODE_ON_DEMAND else 0)
+        self.mode_dropdown.connect("changed", self.on_mode_changed)
+        vbox.pack_start(Gtk.Label(label="Run mode:"), False, False, 0)
+        vbox.pack_start(self.mode_dropdown, False, False, 0)
+
         # Shutdown delay button
         delay_button = Gtk.Button(label="Set Shutdown Delay")
         delay_button.connect("clicked", self.on_set_inhibit_delay_clicked)
@@ -168,6 +288,16 @@ class ConfigWindow(Gtk.Window):
         self.toggle_daemon.connect("toggled", self.on_toggle_daemon)
         vbox.pack_start(self.toggle_daemon, False, False, 0)
 
+        # Checkbox: install updates that no running program uses right away (during the session)
+        self.check_live_updates = Gtk.CheckButton(label="Install Safe Updates Right Away")
+        self.check_live_updates.set_tooltip_text(
+            "Updates for programs that are not running are installed in the background.\n"
+            "Updates for running applications wait for the shutdown."
+        )
+        self.check_live_updates.set_active(install_live_updates)
+        self.check_live_updates.connect("toggled", self.on_toggle_live_updates)
+        vbox.pack_start(self.check_live_updates, False, False, 0)
+
         # Shutdown install options
         shutdown_frame = Gtk.Frame(label="Install Updates at Shutdown")
         shutdown_frame.set_margin_top(10)
@@ -205,6 +335,8 @@ class ConfigWindow(Gtk.Window):
     # Called when the interval dropdown is changed
     def on_interval_changed(self, widget):
         self.save_settings()
+        if self.mode == MODE_ON_DEMAND:
+            write_timer_interval(int(widget.get_active_text().split()[0]))
 
     # Update label based on install-on-shutdown toggle state
     def update_toggle_label(self):
@@ -221,6 +353,7 @@ class ConfigWindow(Gtk.Window):
         config['interval_hours'] = hours
         config['install_on_shutdown'] = self.toggle_install_on_shutdown.get_active()
         config['always_show_prompt'] = self.check_show_prompt.get_active()
+        config['install_live_updates'] = self.check_live_updates.get_active()
         save_config(config)
 
 # Launch settings window
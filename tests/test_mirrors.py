@@ -0,0 +1,161 @@
+"""
+Mirror ranking and source rewriting against local HTTP stand-ins.
+"""
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "opt", "mintupdater"))
+import mirrors  # noqa: E402
+
+PROBE_BYTES = 4096
+TIMEOUT = 1
+
+
+def start_mirror(delay=0.0, stall=False):
+    """
+    Starts a local mirror answering every GET with PROBE_BYTES bytes.
+    delay: seconds before the response; stall: sends a few bytes and then hangs.
+    Returns (base URL, server).
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(206)
+            self.send_header("Content-Length", str(PROBE_BYTES))
+            self.end_headers()
+            if stall:
+                self.wfile.write(b"x" * 16)
+                self.wfile.flush()
+                time.sleep(TIMEOUT * 3)
+                return
+            self.wfile.write(b"x" * PROBE_BYTES)
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_address[1]}/ubuntu", server
+
+
+def refused_url():
+    # A port nobody listens on
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+    return f"http://127.0.0.1:{port}/ubuntu"
+
+
+class RankMirrorsTest(unittest.TestCase):
+    def setUp(self):
+        self.servers = []
+
+    def tearDown(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+
+    def mirror(self, **kwargs):
+        url, server = start_mirror(**kwargs)
+        self.servers.append(server)
+        return url
+
+    def test_fastest_first_and_broken_last(self):
+        slow = self.mirror(delay=0.3)
+        fast = self.mirror()
+        stalled = self.mirror(stall=True)
+        refused = refused_url()
+        results = mirrors.rank_mirrors([stalled, slow, refused, fast], "dists/jammy/Release",
+                                       timeout=TIMEOUT, probe_bytes=PROBE_BYTES)
+        self.assertEqual([r["url"] for r in results[:2]], [fast, slow])
+        self.assertTrue(all(r["healthy"] for r in results[:2]))
+        self.assertEqual({r["url"] for r in results[2:]}, {stalled, refused})
+        self.assertFalse(any(r["healthy"] for r in results[2:]))
+
+    def test_cached_ranking_is_reused(self):
+        fast = self.mirror()
+        slow = self.mirror(delay=0.3)
+        with tempfile.TemporaryDirectory() as d:
+            cache = os.path.join(d, "mirrors.json")
+            first = mirrors.get_ranked_mirrors([slow, fast], 3600, path="dists/jammy/Release",
+                                               cache_path=cache)
+            self.assertEqual(first, [fast, slow])
+            for server in self.servers:
+                server.shutdown()
+                server.server_close()
+            self.servers = []
+            # Both mirrors are gone now, so only the cache can give this order
+            self.assertEqual(mirrors.get_ranked_mirrors([slow, fast], 3600, cache_path=cache), first)
+
+
+class MirrorListTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        d = self.dir.name
+        os.makedirs(os.path.join(d, "parts"))
+        self.sources = os.path.join(d, "sources.list")
+        self.part = os.path.join(d, "parts", "official.list")
+        self.original = (
+            "# main archive\n"
+            "deb [arch=amd64 signed-by=/usr/share/keyrings/a.gpg] http://a.example/ubuntu jammy main # note\n"
+            "deb http://other.example/ jammy main\n"
+        )
+        with open(self.sources, "w") as f:
+            f.write(self.original)
+        with open(self.part, "w") as f:
+            f.write("deb http://b.example/ubuntu/ jammy-updates main\n")
+        os.chmod(self.part, 0o600)
+        self.kwargs = {
+            "mirror_list": os.path.join(d, "lib", "mirrors.txt"),
+            "sources_list": self.sources,
+            "sources_parts": os.path.join(d, "parts"),
+            "backup": os.path.join(d, "lib", "sources.orig"),
+        }
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read(self, path):
+        with open(path) as f:
+            return f.read()
+
+    def test_apply_and_restore(self):
+        candidates = ["http://a.example/ubuntu", "http://b.example/ubuntu"]
+        ranked = ["http://b.example/ubuntu", "http://a.example/ubuntu"]
+        self.assertTrue(mirrors.apply_mirror_list(candidates, ranked, **self.kwargs))
+        uri = "mirror+file:" + self.kwargs["mirror_list"]
+        self.assertIn(f"deb [arch=amd64 signed-by=/usr/share/keyrings/a.gpg] {uri} jammy main\n",
+                      self.read(self.sources))
+        self.assertIn("deb http://other.example/ jammy main\n", self.read(self.sources))
+        self.assertEqual(os.stat(self.part).st_mode & 0o777, 0o600)
+        self.assertEqual(self.read(self.kwargs["mirror_list"]),
+                         "http://b.example/ubuntu/\tpriority:1\nhttp://a.example/ubuntu/\tpriority:2\n")
+
+        # A new ranking only rewrites the list, the sources stay the same
+        before = self.read(self.sources)
+        mirrors.apply_mirror_list(candidates, list(reversed(ranked)), **self.kwargs)
+        self.assertEqual(self.read(self.sources), before)
+
+        self.assertTrue(mirrors.restore_sources(self.kwargs["mirror_list"], self.kwargs["backup"]))
+        self.assertEqual(self.read(self.sources), self.original)
+        self.assertEqual(self.read(self.part), "deb http://b.example/ubuntu/ jammy-updates main\n")
+        self.assertFalse(os.path.exists(self.kwargs["mirror_list"]))
+        self.assertFalse(os.path.exists(self.kwargs["backup"]))
+
+    def test_dropped_candidate_gets_its_source_back(self):
+        mirrors.apply_mirror_list(["http://a.example/ubuntu", "http://b.example/ubuntu"],
+                                  ["http://a.example/ubuntu", "http://b.example/ubuntu"], **self.kwargs)
+        mirrors.apply_mirror_list(["http://a.example/ubuntu", "http://c.example/ubuntu"],
+                                  ["http://c.example/ubuntu", "http://a.example/ubuntu"], **self.kwargs)
+        self.assertEqual(self.read(self.part), "deb http://b.example/ubuntu/ jammy-updates main\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,82 @@
+"""
+Peer cache with several local instances on loopback.
+"""
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import unittest
+import urllib.request
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "opt", "mintupdater"))
+import peer_cache  # noqa: E402
+
+GOOD = b"good package contents" * 100
+BAD = b"evil package contents" * 100  # same size, different hash
+DISCOVERY_PORT = 47899
+
+
+def write(directory, name, data):
+    with open(os.path.join(directory, name), "wb") as f:
+        f.write(data)
+
+
+class PeerCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.dirs = [tempfile.TemporaryDirectory() for _ in range(3)]
+        self.good_dir, self.bad_dir, self.local_dir = (d.name for d in self.dirs)
+        write(self.good_dir, "hello_1.0_all.deb", GOOD)
+        write(self.bad_dir, "hello_1.0_all.deb", BAD)
+        write(self.good_dir, ".hidden.deb", GOOD)
+        self.caches = [
+            peer_cache.PeerCache(port=0, archives_dir=d, discovery_port=DISCOVERY_PORT).start()
+            for d in (self.good_dir, self.bad_dir)
+        ]
+        self.good, self.bad = (f"http://127.0.0.1:{c.port}" for c in self.caches)
+        self.download = ("hello_1.0_all.deb", len(GOOD), "sha256", hashlib.sha256(GOOD).hexdigest())
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.stop()
+        for d in self.dirs:
+            d.cleanup()
+
+    def test_index_and_path_checks(self):
+        with urllib.request.urlopen(self.good + "/index") as response:
+            self.assertEqual(json.load(response)["hello_1.0_all.deb"], len(GOOD))
+        for path in ("/apt/.hidden.deb", "/apt/../../etc/passwd", "/apt/%2e%2e%2fx.deb", "/other"):
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(self.good + path)
+
+    def test_discovery(self):
+        peers = peer_cache.discover_peers(timeout=0.5, port=DISCOVERY_PORT)
+        if not peers:
+            self.skipTest("multicast is not routable here")
+        self.assertEqual({int(p.rsplit(":", 1)[1]) for p in peers}, {c.port for c in self.caches})
+
+    def test_bad_copy_is_rejected(self):
+        source = peer_cache.fetch_from_peers(*self.download, [self.bad, self.good], self.local_dir)
+        self.assertEqual(source, self.good)
+        with open(os.path.join(self.local_dir, "hello_1.0_all.deb"), "rb") as f:
+            self.assertEqual(f.read(), GOOD)
+        self.assertEqual(os.listdir(os.path.join(self.local_dir, "partial")), [])
+
+    def test_only_bad_copies_leave_nothing(self):
+        source = peer_cache.fetch_from_peers(*self.download, [self.bad], self.local_dir)
+        self.assertIsNone(source)
+        self.assertFalse(os.path.exists(os.path.join(self.local_dir, "hello_1.0_all.deb")))
+
+    def test_prefetch_skips_cached_and_counts_fetched(self):
+        missing = ("bye_2.0_all.deb", 3, "sha256", hashlib.sha256(b"bye").hexdigest())
+        with mock.patch.object(peer_cache, "needed_downloads", return_value=[self.download, missing]):
+            stats = peer_cache.prefetch(["apt-get", "upgrade"], [self.good], self.local_dir)
+            self.assertEqual(stats, {"files": 1, "bytes": len(GOOD)})
+            # Already in the archive cache now, nothing to fetch
+            stats = peer_cache.prefetch(["apt-get", "upgrade"], [self.good], self.local_dir)
+            self.assertEqual(stats, {"files": 0, "bytes": 0})
+
+
+if __name__ == "__main__":
+    unittest.main()